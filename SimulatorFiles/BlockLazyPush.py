@@ -1,4 +1,6 @@
 from Blockchain import * 
+from Messages import ReceivedMessages
+from Topology import build_topology
 from simian import Simian
 import random, math, argparse
 
@@ -22,6 +24,26 @@ parser.add_argument("-f", "--fanout", type=int, default=5,
                     help="number of nodes that are selected as gossip targets")
 parser.add_argument("--useMPI", type=int, metavar='MPI', default=0, 
                     help="use mpi")
+parser.add_argument("--scheduler", type=str, metavar='SCHEDULER', default="heap", choices=["heap", "ladder"],
+                    help="event queue of the engine -> heap or ladder, default heap")
+parser.add_argument("--batchEvents", type=int, metavar='BATCH', default=0,
+                    help="drain events with the same timestamp in one pass -> 0-false  1-true")
+parser.add_argument("--workers", type=int, metavar='WORKERS', default=1,
+                    help="number of local worker processes, a shared-memory alternative to --useMPI; results differ from a single process, as every worker has its own random stream and upNodes -> default 1")
+parser.add_argument("--modelledPoW", type=int, metavar='MODELLED', default=0,
+                    help="give mined blocks a cheap stand-in hash instead of searching a real proof of work -> 0-false  1-true")
+parser.add_argument("--maxOrphans", type=int, metavar='ORPHANS', default=4096,
+                    help="blocks a node keeps waiting for a missing parent, the highest ones are dropped first -> default 4096")
+parser.add_argument("--auditChains", type=int, metavar='AUDIT', default=0,
+                    help="validate the chain of every node at the end of the run -> 0-false  1-true")
+parser.add_argument("--retention", type=float, metavar='RETENTION', default=0,
+                    help="seconds after which a node forgets a received message, keeping only its report counters -> 0 keeps every message, default 0")
+parser.add_argument("--logLevel", type=int, metavar='LEVEL', default=1,
+                    help="detail of the .out files -> 1-reports  2-entity placement  3-protocol traces, default 1")
+parser.add_argument("--declareLookahead", type=int, metavar='DECLARE', default=0,
+                    help="declare the message lookahead to the engine, so parallel runs synchronize once per lookahead instead of once per minDelay; changes the model, as transaction and churn delays are then drawn no smaller than the lookahead -> 0-false  1-true")
+parser.add_argument("--repartition", type=float, metavar='INTERVAL', default=0,
+                    help="re-place Node entities on ranks by a min-cut partition of the overlay every INTERVAL time units -> default 0 (round-robin placement)")
 parser.add_argument("--activeChurn", type=int, metavar='CHURN', default=0,
                     help="activates the network churn-> default 0")
 parser.add_argument("--failRate", type=float, metavar='FAILRATE', default=0.0,
@@ -29,6 +51,10 @@ parser.add_argument("--failRate", type=float, metavar='FAILRATE', default=0.0,
 
 args = parser.parse_args()
 
+Blockchain.modelled_pow = args.modelledPoW == 1
+Blockchain.max_orphans = args.maxOrphans
+auditChains = args.auditChains == 1
+
 uMPI = False
 if args.useMPI == 1:
     uMPI = True
@@ -43,6 +69,7 @@ fanout = maxActiveView + maxPassiveView
 random.seed(args.seedR)
 churn = args.activeChurn
 failRate = args.failRate
+retention = args.retention
 
 downNodes = []
 upNodes = []
@@ -50,22 +77,22 @@ upNodes = []
 name = "LazyPushSimulation/"+"LazyPush"+ str(args.total_nodes)+'-Seed'+str(args.seedR)+'-LOOKAHEAD'+str(args.lookahead)+'-CHURN'+str(args.activeChurn)
 
 simName, startTime, endTime, minDelay, useMPI, mpiLib = name, 0, args.endtime, 0.00001, uMPI, "/usr/lib/x86_64-linux-gnu/libmpich.so"
-simianEngine = Simian(simName, startTime, endTime, minDelay, useMPI)
+#Smallest delay of any message between entities. The transaction and churn delays are
+#exponential and have no lower bound, so they are drawn no smaller than this: with
+#--declareLookahead 1 the samples below the lookahead are raised to it, which changes the
+#timing and the event count of the run. Compare such runs only with runs using the flag.
+sendDelay = lookahead if args.declareLookahead == 1 else minDelay
+simianEngine = Simian(simName, startTime, endTime, minDelay, useMPI, scheduler=args.scheduler, bucketWidth=lookahead, batchEvents=args.batchEvents == 1, workers=args.workers, logLevel=args.logLevel)
 
 # Init grid
-positions = []
 # Calculate the grid size
 grid_size = math.ceil(math.sqrt(nodes))
 spacing = math.ceil(math.sqrt(nodes))
 distance = spacing * 2.5
 
-# Place nodes in the grid
-for i in range(nodes):
-    x = i % grid_size
-    y = i // grid_size
-    px = 50 + x * spacing + random.uniform(-20, 20)
-    py = 50 + y * spacing + random.uniform(-20, 20)
-    positions.append((px, py))
+# Place nodes in the grid and link the nodes closer than distance, shared by
+# every Node's GetPeers. The jitter comes from random, seeded with --seedR.
+topology = build_topology(nodes, grid_size, spacing, distance, 20, random)
 
 class msg2:
     def __init__(self,type,m,mID,round,sender):
@@ -92,7 +119,7 @@ class ChurnManager(simianEngine.Entity):
         if len(upNodes) > churn_size:
             to_churn = random.sample(upNodes, churn_size)
             for node_id in to_churn:
-                delay = random.expovariate(1/20)
+                delay = max(random.expovariate(1/20), sendDelay)
                 self.reqService(delay, "force_churn_out", "", "Node", node_id)
 
 class ReportNode(simianEngine.Entity):
@@ -104,8 +131,9 @@ class ReportNode(simianEngine.Entity):
         self.degree = 0
         self.totalMiners = 0
         self.totalTransactions = 0 
-        self.longestChain = []
+        self.longestChain = 0
         self.chainLenghts = 0
+        self.tips = []
         self.maxDegree = 0
         self.minDegree = 1000
         self.shortestPath = 0
@@ -116,8 +144,10 @@ class ReportNode(simianEngine.Entity):
         payload = args[0]
         msg = payload[0]
         trx = payload[1]
-        chain = payload[2]
+        chainLength = payload[2]
         ifminer = payload[3]
+        if payload[4] is not None:
+            self.tips.append(payload[4])
 
         if msg.degree > self.maxDegree:
             self.maxDegree = msg.degree
@@ -143,10 +173,10 @@ class ReportNode(simianEngine.Entity):
         
         self.totalTransactions += trx
 
-        if len(self.longestChain) < len(chain):
-            self.longestChain = chain
+        if self.longestChain < chainLength:
+            self.longestChain = chainLength
         
-        self.chainLenghts += len(chain)
+        self.chainLenghts += chainLength
         
         if ifminer : self.totalMiners += 1
 
@@ -207,12 +237,15 @@ class ReportNode(simianEngine.Entity):
             self.shortestPath /= msgs
             self.shortestPath /= (nodes * (1-failRate))
             average_length = self.chainLenghts / (nodes * (1-failRate))
-            avChainL = average_length /  len(self.longestChain) * 100
+            avChainL = average_length /  self.longestChain * 100
 
 
-            self.out.write("Number of Miners:%d   Total Transactions:%d    Longest Chain:%d     Avarage Chain lenght:%f\n"%(self.totalMiners,self.totalTransactions,len(self.longestChain),avChainL))
+            self.out.write("Number of Miners:%d   Total Transactions:%d    Longest Chain:%d     Avarage Chain lenght:%f\n"%(self.totalMiners,self.totalTransactions,self.longestChain,avChainL))
             self.out.write("AVERAGE--Reliability:%.3f%%    Nodes:%d    Latency:%.1f   RMR:%.3f        Gossip:%d   Inv:%d   Requests:%d\n\n"%(avRel,avNodes,avLat,avRmr,avGossip,avInv,avReq))
         self.out.write("Degree:%.2f  min:%d    max:%d    shortest path:%.2f\n"%(degree,self.minDegree,self.maxDegree,self.shortestPath))
+        if auditChains:
+            valid = Blockchain.validate_many(self.tips)
+            self.out.write("Audited chains:%d   Valid:%d\n"%(len(valid),sum(valid)))
 
 class Node(simianEngine.Entity):
     def __init__(self, baseInfo, *args):
@@ -229,8 +262,7 @@ class Node(simianEngine.Entity):
 
 
         self.peers = []
-        self.receivedMsgs = {}
-        self.report = {}
+        self.receivedMsgs = ReceivedMessages(retention, endTime - 1)
 
         self.GetPeers()
 
@@ -246,17 +278,15 @@ class Node(simianEngine.Entity):
     
         msg = args[0]
 
-        if msg.ID not in self.report.keys():
-            self.report[msg.ID] = [1,0,0]
-        else:
-            self.report[msg.ID][0] += 1
+        self.receivedMsgs.count(msg.ID, 0, self.engine.now)
         
 
         if msg.ID not in self.receivedMsgs.keys() and msg.round < maxrounds:
-            self.receivedMsgs[msg.ID] = msg
+            self.receivedMsgs.add(msg.ID, msg.type, msg.payload, msg.round, self.engine.now)
+            self.receivedMsgs.expire_old(self.engine.now)
 
             if msg.type  == "BLOCK":
-                block = Block.from_dict(msg.payload)
+                block = shared_block(msg.payload)
                 accepted = self.blockchain.consensus(block)
                 if accepted:
                     self.blockchain.remove_confirmed_transactions(block)
@@ -268,7 +298,7 @@ class Node(simianEngine.Entity):
             elif msg.type  == "TRX":
                 if self.miner:
                     self.blockchain.add_new_transaction(msg.payload)
-                    if self.miner and not self.mining and len(self.blockchain.unconfirmed_transactions) >= 100:
+                    if self.miner and not self.mining and len(self.blockchain.mempool) >= 100:
                         self.mining = True
                         avg_mining_time = 30
                         delay = random.expovariate(1/avg_mining_time)
@@ -282,26 +312,21 @@ class Node(simianEngine.Entity):
             self.blockchain.mine()
             new_block = self.blockchain.last_block
             block_id = "B-" +str(random.randint(11111111,99999999))
-            block_msg = msg2("BLOCK", new_block.to_dict(), block_id, 0, self.node_idx)
-            self.receivedMsgs[block_msg.ID] = block_msg
-            self.report[block_msg.ID] = [1, 0, 0]
+            block_msg = msg2("BLOCK", new_block, block_id, 0, self.node_idx)
+            self.receivedMsgs.add(block_msg.ID, block_msg.type, block_msg.payload, block_msg.round, self.engine.now, [1, 0, 0])
             self.SendInv(block_msg.ID)
             self.mining = False
 
 
     def SendInv(self, msg_id):
-        for peer in self.peers:
-            self.reqService(lookahead, "ReceiveInv", (msg_id, self.node_idx), "Node", peer)
+        self.reqServiceMulti(lookahead, "ReceiveInv", (msg_id, self.node_idx), "Node", self.peers)
 
     def ReceiveInv(self, *args):
         if not self.active:
             return
         msg_id, sender_id = args[0]
 
-        if msg_id not in self.report.keys():
-            self.report[msg_id] = [0,1,0]
-        else:
-            self.report[msg_id][1] += 1
+        self.receivedMsgs.count(msg_id, 1, self.engine.now)
 
         if msg_id not in self.receivedMsgs:
             self.reqService(lookahead, "RequestMessage", (msg_id, self.node_idx), "Node", sender_id)
@@ -309,27 +334,15 @@ class Node(simianEngine.Entity):
     def RequestMessage(self, *args):
         msg_id, requester_id = args[0]
 
-        if msg_id not in self.report.keys():
-            self.report[msg_id] = [0,0,1]
-        else:
-            self.report[msg_id][2] += 1
+        self.receivedMsgs.count(msg_id, 2, self.engine.now)
 
         if msg_id in self.receivedMsgs:
-            msg = self.receivedMsgs[msg_id]
-            self.reqService(lookahead, "Receive", msg2(msg.type , msg.payload , msg.ID, msg.round + 1 , msg.sender), "Node", requester_id)
+            payloadType, payload = self.receivedMsgs.payload(msg_id)
+            self.reqService(lookahead, "Receive", msg2(payloadType , payload , msg_id, self.receivedMsgs.round(msg_id) + 1 , self.node_idx), "Node", requester_id)
     
 
     def GetPeers(self):
-        xp, yp = positions[self.node_idx]
-        self.peers = []
-
-        for peer in range(self.total_nodes):
-            if peer == self.node_idx:
-                continue
-            x, y = positions[peer]
-            d = math.dist((xp, yp), (x, y))  # Python ≥3.8
-            if d < distance:
-                self.peers.append(peer)
+        self.peers = topology.neighbours(self.node_idx)
 
         # Randomize and reduce to fanout
         if len(self.peers) > fanout:
@@ -339,13 +352,12 @@ class Node(simianEngine.Entity):
 
     def TriggerSystemReport(self,*args):
         if self.active:
-            report = []
+            report = self.receivedMsgs.report_entries()
             degree = len(self.peers)
-            for m in self.receivedMsgs.keys():
-                report.append((m,self.receivedMsgs[m].round,self.report[m][0],self.report[m][1],self.report[m][2]))
 
             msgToSend = msgReport('reply',report,degree)
-            self.reqService(lookahead, "SystemReport", [msgToSend, self.trxMade , self.blockchain.chain, self.miner] , "ReportNode", 0)
+            self.reqService(lookahead, "SystemReport", [msgToSend, self.trxMade , self.blockchain.chain_length(), self.miner,
+                        self.blockchain.best if auditChains else None] , "ReportNode", 0)
 
     def UpdatePeers(self, *args):
         self.GetPeers()
@@ -358,11 +370,8 @@ class Node(simianEngine.Entity):
         if self.active:
             self.active = False
             self.peers = []
-            self.blockchain.chain = []
-            self.blockchain.forks = {}
-            self.blockchain.orphans = []
-            self.receivedMsgs = {}
-            self.report = {}
+            self.blockchain.clear()
+            self.receivedMsgs.clear()
 
             if self.node_idx in upNodes:
                 upNodes.remove(self.node_idx)
@@ -372,7 +381,7 @@ class Node(simianEngine.Entity):
     def create_transaction(self,*args):
         n = random.choice(upNodes)
         avg_transactionT = .7
-        delay = random.expovariate(1/avg_transactionT)
+        delay = max(random.expovariate(1/avg_transactionT), sendDelay)
         if self.active and not self.miner:
             transaction = Transaction(self.node_idx)
             tx_msg = msg2("TRX", transaction, transaction.trans_id, 0, self.node_idx)
@@ -383,6 +392,13 @@ class Node(simianEngine.Entity):
             self.reqService(delay , "create_transaction", "" , "Node", n)
 
 
+if args.declareLookahead == 1:
+    for entityName in ("Node", "ReportNode", "ChurnManager"):
+        simianEngine.setLookahead(entityName, sendDelay)
+
+if args.repartition > 0:
+    simianEngine.setPartitioner("Node", lambda node: node.peers, args.repartition)
+
 for i in range(0, nodes):
     simianEngine.addEntity("Node", Node, i, i, nodes)
 
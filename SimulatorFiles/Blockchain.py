@@ -1,15 +1,172 @@
 from hashlib import sha256
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from array import array
+import atexit
+import heapq
 import random
 import json
+import struct
 import time
+import weakref
+
+
+EMPTY_ROOT = bytes(32)
+
+
+class MerkleTree:
+    """
+    Merkle tree over 32-byte leaf hashes: pairs are hashed level by level,
+    an odd last node is paired with itself, and no leaves give EMPTY_ROOT.
+    All levels are kept, so appending or truncating leaves re-hashes only
+    the right edge of the tree, and inclusion proofs are read off directly.
+    """
+
+    def __init__(self, leaves=()):
+        level = list(leaves)
+        self.levels = [level]
+        while len(level) > 1:
+            level = [sha256(level[i] + level[min(i + 1, len(level) - 1)]).digest() for i in range(0, len(level), 2)]
+            self.levels.append(level)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def root(self):
+        if not self.levels[0]:
+            return EMPTY_ROOT
+        return self.levels[-1][0]
+
+    def append(self, leaf):
+        self.levels[0].append(leaf)
+        self._update_edge()
+
+    def truncate(self, size):
+        """Keeps the first size leaves."""
+        del self.levels[0][size:]
+        self._update_edge()
+
+    def _update_edge(self):
+        # Re-hash the ancestors of the last leaf, dropping nodes right of them
+        i = len(self.levels[0]) - 1
+        k = 0
+        while len(self.levels[k]) > 1:
+            level = self.levels[k]
+            j = i // 2
+            node = sha256(level[2 * j] + level[min(2 * j + 1, len(level) - 1)]).digest()
+            if k + 1 == len(self.levels):
+                self.levels.append([])
+            parent = self.levels[k + 1]
+            del parent[j:]
+            parent.append(node)
+            i = j
+            k += 1
+        del self.levels[k + 1:]
+
+    def proof(self, index):
+        """
+        Inclusion proof of leaf index: the sibling hashes from the leaf up,
+        as (hash, sibling_is_right) pairs.
+        """
+        path = []
+        for level in self.levels[:-1]:
+            sibling = min(index ^ 1, len(level) - 1)
+            path.append((level[sibling], index % 2 == 0))
+            index //= 2
+        return path
+
+    @staticmethod
+    def verify(leaf, proof, root):
+        """Checks an inclusion proof of leaf against a Merkle root."""
+        node = leaf
+        for sibling, sibling_is_right in proof:
+            node = sha256(node + sibling).digest() if sibling_is_right else sha256(sibling + node).digest()
+        return node == root
+
+    def copy(self):
+        tree = MerkleTree()
+        tree.levels = [list(level) for level in self.levels]
+        return tree
+
+
+def merkle_root(leaves):
+    """Merkle root of a list of 32-byte leaf hashes (see MerkleTree)."""
+    return MerkleTree(leaves).root()
+
+
+def pow_target(difficulty):
+    """
+    Bound on the binary digest of a valid block: a hex digest starts with
+    difficulty zeros exactly when its digest is below this value.
+    """
+    if difficulty <= 0:
+        return b"\xff" * 33  # longer than a digest, so above all of them
+    return (1 << max(256 - 4 * difficulty, 0)).to_bytes(32, "big")
+
+
+def scan_nonces(prefix, start, stop, target):
+    """
+    First nonce in [start, stop) whose header hash is below target, or
+    None. The SHA-256 state after the fixed header prefix (the midstate)
+    is computed once and copied for every nonce.
+    """
+    copy = sha256(prefix).copy
+    pack = Block.NONCE.pack
+    for nonce in range(start, stop):
+        h = copy()
+        h.update(pack(nonce))
+        if h.digest() < target:
+            return nonce
+    return None
+
+
+_mining_pool = None
+_mining_pool_workers = 0
+
+
+def _get_mining_pool(workers):
+    global _mining_pool, _mining_pool_workers
+    if _mining_pool_workers != workers:
+        if _mining_pool is not None:
+            _mining_pool.shutdown()
+        _mining_pool = ProcessPoolExecutor(workers)
+        _mining_pool_workers = workers
+    return _mining_pool
+
+
+@atexit.register
+def _shutdown_mining_pool():
+    if _mining_pool is not None:
+        _mining_pool.shutdown()
 
 
 class Transaction:
+    """
+    A transaction: its number (trans_id is "T-<number>"), author and creation
+    time. The human-readable content is rendered from those when it is read,
+    unless a different content was set.
+    """
+    __slots__ = ("number", "author", "timestamp", "_content")
+
     def __init__(self, author):
-        self.trans_id = "T-" +str(random.randint(11111111,99999999))
+        self.number = random.randint(11111111,99999999)
         self.author = author
         self.timestamp = time.time()
-        self.content = "Transaccion de " + str(self.author) + " con numero " + self.trans_id +" con tiempo "+ str(self.timestamp)
+        self._content = None
+
+    @property
+    def trans_id(self):
+        return "T-" + str(self.number)
+
+    @property
+    def content(self):
+        if self._content is not None:
+            return self._content
+        return "Transaccion de " + str(self.author) + " con numero " + self.trans_id +" con tiempo "+ str(self.timestamp)
+
+    @content.setter
+    def content(self, content):
+        self._content = content
 
     def __str__(self):
         return f"Transaction(trans_id={self.trans_id}, author={self.author}, timestamp={self.timestamp} , content={self.content})"
@@ -22,26 +179,93 @@ class Transaction:
             "content": self.content
         }
 
+    def hash_bytes(self):
+        """Leaf hash of the transaction: sha256 of its canonical JSON form."""
+        return sha256(json.dumps(self.to_dict(), sort_keys=True, separators=(",", ":")).encode()).digest()
+
+    @classmethod
+    def record(cls, number, author, timestamp, content=None):
+        """A transaction from its fields, without drawing a new number."""
+        tx = cls.__new__(cls)
+        tx.number = number
+        tx.author = author
+        tx.timestamp = timestamp
+        tx._content = content
+        return tx
+
     @classmethod
     def from_dict(cls, data):
-        tx = cls(data["author"])
-        tx.trans_id = data["trans_id"]
-        tx.timestamp = data["timestamp"]
-        tx.content = data["content"]
+        tx = cls.record(int(data["trans_id"][2:]), data["author"], data["timestamp"])
+        if data["content"] != tx.content:
+            tx.content = data["content"]
         return tx
 
+
+class TransactionBatch:
+    """
+    The transactions of a block stored column-wise in arrays, the form in
+    which blocks are pickled to other processes. Authors are packed into an
+    array when they are all ints, the node numbers the simulators use, and
+    kept in a list otherwise. Indexing and iterating give back Transaction
+    records.
+    """
+    def __init__(self, transactions=()):
+        self.numbers = array("q")
+        authors = []
+        self.timestamps = array("d")
+        # index -> content, for the transactions whose content was set
+        self.contents = {}
+        for tx in transactions:
+            if tx._content is not None:
+                self.contents[len(self.numbers)] = tx._content
+            self.numbers.append(tx.number)
+            authors.append(tx.author)
+            self.timestamps.append(tx.timestamp)
+        self.authors = authors
+        if all(type(author) is int for author in authors):
+            try:
+                self.authors = array("q", authors)
+            except OverflowError:
+                pass
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.numbers)
+        return Transaction.record(self.numbers[index], self.authors[index],
+                                  self.timestamps[index], self.contents.get(index))
+
+    def __iter__(self):
+        contents = self.contents
+        for i, number in enumerate(self.numbers):
+            yield Transaction.record(number, self.authors[i], self.timestamps[i], contents.get(i))
+
+
 class Block:
-    def __init__(self, index, transactions, timestamp, previous_hash, nonce=0):
+    # Binary header: index, previous hash, Merkle root, timestamp (88 bytes
+    # with the nonce). Only the nonce changes while mining, so everything
+    # before it is serialized once and cached.
+    HEADER = struct.Struct(">Q32s32sd")
+    NONCE = struct.Struct(">Q")
+
+    def __init__(self, index, transactions, timestamp, previous_hash, nonce=0, merkle_tree=None):
         self.index = index
         self.transactions = transactions
         self.timestamp = timestamp
         self.previous_hash = previous_hash
         self.nonce = nonce
+        self._header_key = None
+        self._header = None
+        # A tree already built over transactions can be handed in by the miner
+        self._tree = merkle_tree
+        self._tree_key = None if merkle_tree is None else (id(transactions), len(transactions))
 
     def to_dict(self):
         return {
             "index": self.index,
-            "transactions": [tx.__dict__ for tx in self.transactions],
+            "transactions": [tx.to_dict() for tx in self.transactions],
             "timestamp": self.timestamp,
             "previous_hash": self.previous_hash,
             "nonce": self.nonce,
@@ -58,18 +282,61 @@ class Block:
             nonce=data["nonce"]
         )
         block.hash = data.get("hash")
-        return block    
+        return block
+
+    def __getstate__(self):
+        # Blocks sent to another process leave their cached header and tree behind
+        state = self.__dict__.copy()
+        state.update(_header_key=None, _header=None, _tree=None, _tree_key=None)
+        if not isinstance(self.transactions, TransactionBatch):
+            state["transactions"] = TransactionBatch(self.transactions)
+        return state
+
+    def merkle_tree(self):
+        """Merkle tree over the transactions, rebuilt if the list is replaced or resized."""
+        key = (id(self.transactions), len(self.transactions))
+        if key != self._tree_key:
+            self._tree = MerkleTree([tx.hash_bytes() for tx in self.transactions])
+            self._tree_key = key
+        return self._tree
+
+    def merkle_root(self):
+        return self.merkle_tree().root()
+
+    def inclusion_proof(self, index):
+        """
+        Proof that transactions[index] is part of this block, to be checked
+        with MerkleTree.verify(tx.hash_bytes(), proof, root) against the
+        root of the block header.
+        """
+        return self.merkle_tree().proof(index)
+
+    def header_prefix(self):
+        """
+        Serialized header without the nonce. It is rebuilt only when a
+        header field changes or the transaction list is replaced or resized.
+        """
+        key = (self.index, self.previous_hash, self.timestamp, id(self.transactions), len(self.transactions))
+        if key != self._header_key:
+            previous = bytes.fromhex(self.previous_hash.rjust(64, "0"))
+            self._header = Block.HEADER.pack(self.index, previous, self.merkle_root(), self.timestamp)
+            self._header_key = key
+        return self._header
 
     def compute_hash(self):
-        block_content = {
-            "index": self.index,
-            "transactions": [tx.__dict__ for tx in self.transactions],
-            "timestamp": self.timestamp,
-            "previous_hash": self.previous_hash,
-            "nonce": self.nonce
-        }
-        block_string = json.dumps(block_content, sort_keys=True)
-        return sha256(block_string.encode()).hexdigest()
+        if Blockchain.modelled_pow:
+            return self.modelled_hash()
+        return sha256(self.header_prefix() + Block.NONCE.pack(self.nonce)).hexdigest()
+
+    def modelled_hash(self):
+        """
+        Hash of a block under modelled PoW: one digest of the header fields
+        and transaction ids, with the leading zeros of the difficulty put in
+        place instead of searched for.
+        """
+        ids = ",".join(tx.trans_id for tx in self.transactions)
+        digest = sha256(f"{self.index}|{self.previous_hash}|{self.timestamp!r}|{ids}".encode()).hexdigest()
+        return "0" * Blockchain.difficulty + digest[Blockchain.difficulty:]
     
     def __str__(self):
         return f"BLOCK (ID = {self.index}, TRX={str(len(self.transactions))}, timestamp={self.timestamp} , PREVIHASH={self.previous_hash})"
@@ -78,15 +345,195 @@ class Block:
         return self.__str__()
 
 
+class BlockNode:
+    """
+    A block of the block tree, with its parent node, its height (0 for the
+    genesis block) and the cumulative work from the genesis block to it.
+    Nodes are shared by every Blockchain of the process (see tree_node), so
+    forks share the nodes of their common prefix. verified is set once
+    Blockchain.validate_tip has checked the block and all its ancestors.
+    """
+    __slots__ = ("block", "parent", "height", "work", "verified", "__weakref__")
+
+    def __init__(self, block, parent):
+        self.block = block
+        self.parent = parent
+        self.verified = False
+        if parent is None:
+            self.height = 0
+            self.work = 0
+        else:
+            self.height = parent.height + 1
+            self.work = parent.work + Blockchain.block_work()
+
+    def __reduce__(self):
+        # Pickled as the flat list of blocks from the genesis block, which the
+        # receiving process interns into its own block tree (and checks again)
+        blocks = []
+        node = self
+        while node is not None:
+            blocks.append(node.block)
+            node = node.parent
+        blocks.reverse()
+        return (_tree_path, (blocks,))
+
+
+# Blocks known to this process, by hash. A mined block is never modified, so
+# all the nodes of a process hold references to one shared object per block.
+# Entries go away with the last chain holding the block.
+_block_store = weakref.WeakValueDictionary()
+
+def shared_block(block):
+    """
+    The block object shared by this process for block.hash: block itself the
+    first time, otherwise the copy already stored (a block received from
+    another process arrives as a fresh unpickled copy).
+    """
+    return _block_store.setdefault(block.hash, block)
+
+# Block tree shared by the chains of this process: hash -> BlockNode
+_tree_nodes = weakref.WeakValueDictionary()
+
+def tree_node(block, parent):
+    """The shared BlockNode of block under parent, created on first use."""
+    node = _tree_nodes.get(block.hash)
+    if node is None:
+        node = BlockNode(block, parent)
+        _tree_nodes[block.hash] = node
+    return node
+
+def _tree_path(blocks):
+    """The BlockNode of the last of blocks, a path from the genesis block."""
+    node = None
+    for block in blocks:
+        node = tree_node(shared_block(block), node)
+    return node
+
+
+class Mempool:
+    """
+    Unconfirmed transactions keyed by transaction number, in arrival order. A
+    transaction whose number is already pooled is ignored.
+    """
+    def __init__(self):
+        self.txs = {}
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, number):
+        return number in self.txs
+
+    def add(self, transaction):
+        self.txs.setdefault(transaction.number, transaction)
+
+    def head(self, count):
+        """The count oldest transactions, the content of the next block."""
+        return list(islice(self.txs.values(), count))
+
+    def remove(self, numbers):
+        for number in numbers:
+            self.txs.pop(number, None)
+
+
+class OrphanPool:
+    """
+    Blocks whose parent is not known yet, indexed by the hash of the missing
+    parent so that a new block only wakes the orphans waiting on it. Holds at
+    most max_size blocks; when full the highest orphan is evicted, the one
+    furthest from any known parent. An orphan is therefore never dropped
+    while an orphan built on it is kept, and the orphans closest to the
+    chain, the first to attach, stay.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # hash -> block, in arrival order
+        self.by_hash = {}
+        # previous_hash -> {hash: block}
+        self.waiting = {}
+        # (-index, arrival, hash) heap of the orphans, for eviction. Entries
+        # of orphans already removed are skipped when they come up.
+        self.heights = []
+        self.arrivals = 0
+
+    def __len__(self):
+        return len(self.by_hash)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.by_hash
+
+    def add(self, block):
+        if block.hash in self.by_hash:
+            return
+        if len(self.by_hash) >= self.max_size:
+            highest = self.highest()
+            if highest is None or block.index >= highest.index:
+                return
+            self.remove(highest.hash)
+        self.by_hash[block.hash] = block
+        self.waiting.setdefault(block.previous_hash, {})[block.hash] = block
+        self.arrivals += 1
+        heapq.heappush(self.heights, (-block.index, self.arrivals, block.hash))
+        if len(self.heights) > 2 * len(self.by_hash) + 64:
+            self.heights = [entry for entry in self.heights if entry[2] in self.by_hash]
+            heapq.heapify(self.heights)
+
+    def highest(self):
+        """The orphan with the highest index, the oldest one among equals."""
+        heights = self.heights
+        while heights and heights[0][2] not in self.by_hash:
+            heapq.heappop(heights)
+        return self.by_hash[heights[0][2]] if heights else None
+
+    def remove(self, block_hash):
+        block = self.by_hash.pop(block_hash, None)
+        if block is not None:
+            children = self.waiting[block.previous_hash]
+            del children[block_hash]
+            if not children:
+                del self.waiting[block.previous_hash]
+
+    def pop_children(self, parent_hash):
+        """Remove and return the orphans whose parent is parent_hash."""
+        children = self.waiting.pop(parent_hash, None)
+        if children is None:
+            return []
+        for block_hash in children:
+            del self.by_hash[block_hash]
+        return list(children.values())
+
+
 class Blockchain:
     # difficulty of our PoW algorithm
     difficulty = 1
+    # transactions per mined block
+    block_size = 100
+    # nonces per scan_nonces() call, and processes sharing the scan
+    # (1 mines in this process)
+    mining_batch = 1 << 16
+    mining_workers = 1
+    # Modelled PoW: the block time is modelled by the simulation, so blocks
+    # get a cheap stand-in hash (Block.modelled_hash), no nonce is searched
+    # and proofs are only checked for the difficulty prefix. Real PoW is
+    # kept for validation runs.
+    modelled_pow = False
+    # blocks kept waiting for a missing parent (see OrphanPool)
+    max_orphans = 4096
+    # forks whose tip falls more than this many blocks below the best tip are
+    # dropped, with the blocks only they hold
+    max_fork_depth = 6
 
     def __init__(self):
-        self.unconfirmed_transactions = []
-        self.chain = []
-        self.forks = {}
-        self.orphans = []
+        self.mempool = Mempool()
+        # Leaves of the block tree this chain holds: hash -> BlockNode. The
+        # main chain is the path from the best tip back to the genesis block.
+        self.tips = {}
+        self.best = None
+        self.orphans = OrphanPool(Blockchain.max_orphans)
+        # The transactions of the next block to mine, mempool.head(block_size),
+        # and the Merkle tree over the leading ones that were hashed so far
+        self._pending_txs = []
+        self._pending_tree = MerkleTree()
 
     def create_genesis_block(self):
         """
@@ -96,11 +543,52 @@ class Blockchain:
         """
         genesis_block = Block(0, [], 0, "0")
         genesis_block.hash = genesis_block.compute_hash()
-        self.chain.append(genesis_block)
+        self.attach(shared_block(genesis_block), None)
+
+    def clear(self):
+        """Drop every block, as when the node leaves the network."""
+        self.tips = {}
+        self.best = None
+        self.orphans = OrphanPool(Blockchain.max_orphans)
+
+    @staticmethod
+    def block_work():
+        """Expected number of hashes to find a proof at the current difficulty."""
+        return 16 ** Blockchain.difficulty
 
     @property
     def last_block(self):
-        return self.chain[-1]
+        return self.best.block
+
+    @property
+    def chain(self):
+        """The main chain as a list, from the genesis block to the best tip."""
+        blocks = []
+        node = self.best
+        while node is not None:
+            blocks.append(node.block)
+            node = node.parent
+        blocks.reverse()
+        return blocks
+
+    def chain_length(self):
+        return 0 if self.best is None else self.best.height + 1
+
+    def find(self, block_hash, height):
+        """
+        The BlockNode of block_hash at the given height if the block is on
+        the main chain or a fork of this chain, else None. Blocks near a tip
+        are found after a walk as deep as the block is below the tip.
+        """
+        node = self.tips.get(block_hash)
+        if node is not None:
+            return node
+        for node in self.tips.values():
+            while node is not None and node.height > height:
+                node = node.parent
+            if node is not None and node.block.hash == block_hash:
+                return node
+        return None
     
     def block_validity(self, block, proof):
 
@@ -112,17 +600,41 @@ class Blockchain:
 
     def add_block(self, block):
         """
-        A function that adds the block to the chain after verification.
-        Verification includes:
-        * Checking if the proof is valid.
-        * The previous_hash referred in the block and the hash of latest block
-          in the chain match.
+        A function that adds a verified block on top of the main chain.
         """
-        
-        self.chain.append(block)
-        #print("I added the block")
+        self.attach(block, self.best)
         return True
-            
+
+    def attach(self, block, parent):
+        """
+        Add the block to the block tree under parent, the BlockNode of its
+        previous block. A block on the best tip extends the main chain; a
+        fork becomes the main chain once it carries more than one block of
+        work beyond it. Tips more than max_fork_depth blocks below the best
+        tip are pruned, the new one included.
+        """
+        node = tree_node(block, parent)
+        if parent is not None:
+            self.tips.pop(parent.block.hash, None)
+        self.tips[block.hash] = node
+
+        if (self.best is None or block.previous_hash == self.best.block.hash or
+                node.work > self.best.work + Blockchain.block_work()):
+            self.best = node
+            self.prune_tips()
+        elif node.height < self.fork_floor():
+            del self.tips[block.hash]
+        return node
+
+    def fork_floor(self):
+        """Lowest height a fork tip can have without being pruned."""
+        return self.best.height - Blockchain.max_fork_depth
+
+    def prune_tips(self):
+        """Drop the fork tips that fell more than max_fork_depth blocks below the best tip."""
+        floor = self.fork_floor()
+        for block_hash in [h for h, node in self.tips.items() if node.height < floor]:
+            del self.tips[block_hash]
 
     @staticmethod
     def proof_of_work(block):
@@ -130,24 +642,61 @@ class Blockchain:
         Function that tries different values of nonce to get a hash
         that satisfies our difficulty criteria.
         """
-        block.nonce = 0
-
-        computed_hash = block.compute_hash()
-        while not computed_hash.startswith('0' * Blockchain.difficulty):
-            block.nonce += 1
-            computed_hash = block.compute_hash()
-
-        return computed_hash
+        if Blockchain.modelled_pow:
+            block.nonce = 0
+            return block.compute_hash()
+
+        prefix = block.header_prefix()
+        target = pow_target(Blockchain.difficulty)
+        batch = Blockchain.mining_batch
+        workers = Blockchain.mining_workers
+        start = 0
+        nonce = None
+        while nonce is None:
+            if workers > 1:
+                # One batch per process, the lowest nonce found wins, so the
+                # result is the same as scanning in this process
+                pool = _get_mining_pool(workers)
+                starts = [start + i * batch for i in range(workers)]
+                found = pool.map(scan_nonces, [prefix] * workers, starts,
+                                 [s + batch for s in starts], [target] * workers)
+                nonce = next((n for n in found if n is not None), None)
+                start += workers * batch
+            else:
+                nonce = scan_nonces(prefix, start, start + batch, target)
+                start += batch
+
+        block.nonce = nonce
+        return block.compute_hash()
 
     def add_new_transaction(self, transaction):
-        self.unconfirmed_transactions.append(transaction)
+        if transaction.number in self.mempool:
+            return
+        self.mempool.add(transaction)
+        if len(self._pending_txs) < Blockchain.block_size:
+            self._pending_txs.append(transaction)
+
+    def pending_tree(self):
+        """
+        Merkle tree over the transactions of the next block, the first
+        block_size unconfirmed ones. The tree is kept as transactions join
+        and leave the pending block, so every transaction is hashed once
+        while it stays pending.
+        """
+        tree = self._pending_tree
+        for tx in self._pending_txs[len(tree):]:
+            tree.append(tx.hash_bytes())
+        return tree
 
     @classmethod
     def is_valid_proof(cls, block, block_hash):
         """
         Check if block_hash is valid hash of block and satisfies
-        the difficulty criteria.
+        the difficulty criteria. Under modelled PoW only the difficulty
+        prefix is checked.
         """
+        if Blockchain.modelled_pow:
+            return block_hash.startswith('0' * Blockchain.difficulty)
         return (block_hash.startswith('0' * Blockchain.difficulty) and
                 block_hash == block.compute_hash())
 
@@ -158,6 +707,14 @@ class Blockchain:
         previous_hash = "0"
     
         for block in chain:
+            if Blockchain.modelled_pow:
+                # Modelled hashes carry no proof, only the links are checked
+                if previous_hash != block.previous_hash:
+                    result = False
+                    break
+                previous_hash = block.hash
+                continue
+
             # Reconstruct block to recompute its hash
             reconstructed = Block(
                 index=block.index,
@@ -178,28 +735,71 @@ class Blockchain:
     
         return result
 
+    @staticmethod
+    def validate_tip(tip):
+        """
+        Check the chain ending at the BlockNode tip: the previous_hash links
+        and the hash of every block, and the proof of every block after the
+        genesis one. Checked nodes are marked verified, and the tree is shared
+        by the chains of the process, so the verified blocks are a watermark
+        below which nothing is checked again: after an extension or a
+        reorganization only the new blocks are checked.
+        """
+        path = []
+        node = tip
+        while node is not None and not node.verified:
+            path.append(node)
+            node = node.parent
+
+        for node in reversed(path):
+            block = node.block
+            if node.parent is None:
+                valid = block.previous_hash == "0" and block.hash == block.compute_hash()
+            else:
+                valid = (block.previous_hash == node.parent.block.hash and
+                         Blockchain.is_valid_proof(block, block.hash))
+            if not valid:
+                return False
+            node.verified = True
+        return True
+
+    @staticmethod
+    def validate_many(tips):
+        """
+        validate_tip for each of tips, e.g. the best tips of every node. A
+        block shared by several chains is checked once.
+        """
+        return [Blockchain.validate_tip(tip) for tip in tips]
+
+    def validate(self):
+        """Check the main chain (see validate_tip)."""
+        return self.best is None or Blockchain.validate_tip(self.best)
+
     def mine(self):
         """
         This function serves as an interface to add the pending
         transactions to the blockchain by adding them to the block
         and figuring out Proof Of Work.
         """
-        if not self.unconfirmed_transactions:
+        if not self.mempool:
             return False
 
         last_block = self.last_block
 
+        transactions = list(self._pending_txs)
+        tree = None if Blockchain.modelled_pow else self.pending_tree().copy()
         new_block = Block(index=last_block.index + 1,
-                          transactions=self.unconfirmed_transactions[:100],
+                          transactions=transactions,
                           timestamp=time.time(),
-                          previous_hash=last_block.hash)
+                          previous_hash=last_block.hash,
+                          merkle_tree=tree)
         
         proof = self.proof_of_work(new_block)
 
         if Blockchain.is_valid_proof(new_block, proof):
             new_block.hash = proof
             self.add_block(new_block)
-            self.unconfirmed_transactions = self.unconfirmed_transactions[100:]
+            self.remove_confirmed_transactions(new_block)
             return True
 
         return False
@@ -210,85 +810,53 @@ class Blockchain:
            #print(f"❌ Invalid block {block.index}")
             return False
 
-        # Step 2: Normal chain extension
-        if block.previous_hash == self.last_block.hash:
-            self.add_block(block)
-            self.resolve_forks()
-            self.remove_if_orphan(block)
-            self.try_attach_orphans()
+        # Step 2: Block already on the main chain or a fork
+        if self.find(block.hash, block.index) is not None:
             return True
 
-        # Step 3: Extends an existing fork
-        elif block.previous_hash in self.forks:
-            #print(f"🔀 Block {block.index} extends known fork")
-            self.forks[block.previous_hash][0].append(block)
-            self.forks[block.hash] = self.forks.pop(block.previous_hash)
-            self.resolve_forks()
-            self.remove_if_orphan(block)
-            self.try_attach_orphans()
-            return True
+        # Step 3: Stale block, on a fork that would be pruned at once
+        if self.best is not None and block.index < self.fork_floor():
+            self.orphans.remove(block.hash)
+            return False
 
-        # Step 4: Fork from main chain (fork base exists in chain)
-        elif block.previous_hash in self.chain_hashes():
-            base_index = self.chain_index(block.previous_hash)
-            self.forks[block.hash] = ([block], base_index)
-            #print(f"🌱 New fork started at block {block.index}")
-            self.remove_if_orphan(block)
-            self.try_attach_orphans()
+        parent = self.find(block.previous_hash, block.index - 1)
+        # Step 4: Extends the main chain or a fork
+        if parent is not None:
+            self.orphans.remove(block.hash)
+            self.attach_orphans(self.attach(block, parent))
             return True
 
         # Step 5: Orphan block (no parent known yet)
         else:
             #print(f"🧩 Orphan block received: {block.index}")
-            if block not in self.orphans:
-                self.orphans.append(block)
+            self.orphans.add(block)
             return False
 
 
-    def resolve_forks(self):
-        longest_chain = self.chain
-        for fork_blocks, base_index in self.forks.values():
-            candidate_chain = self.chain[:base_index + 1] + fork_blocks
-            if len(candidate_chain) > len(longest_chain):
-                longest_chain = candidate_chain
-
-        if len(longest_chain) > len(self.chain) + 1:
-            self.chain = longest_chain
-            #print("Fork resolved — replaced with longer fork")
-
-
-    def remove_if_orphan(self, block):
-        """Safely remove a block from orphans if it's there."""
-        try:
-            self.orphans.remove(block)
-        except ValueError:
-            pass
-
-    def try_attach_orphans(self):
-        """Try attaching all known orphans to current chain or forks."""
-        reattachable = []
-        for orphan in self.orphans:
-            if self.consensus(orphan):
-                reattachable.append(orphan)
-    
-        # Remove attached orphans
-        if reattachable:
-            #print(f"🔁 Reattached {len(reattachable)} orphan(s)")
-            self.orphans = [o for o in self.orphans if o not in reattachable]
-
+    def attach_orphans(self, node):
+        """
+        Attach the orphans waiting on the block of node, then the orphans
+        waiting on those, and so on. Orphans were validated when they were
+        received.
+        """
+        parents = [node]
+        while parents:
+            parent = parents.pop()
+            for orphan in self.orphans.pop_children(parent.block.hash):
+                if self.find(orphan.hash, orphan.index) is None:
+                    parents.append(self.attach(orphan, parent))
 
-    def chain_hashes(self):
-        return {block.hash for block in self.chain}
 
-    def chain_index(self, hash_value):
-        for i, block in enumerate(self.chain):
-            if block.hash == hash_value:
-                return i
-        return 0
 
-    
     def remove_confirmed_transactions(self, block):
-        self.unconfirmed_transactions = [
-            tx for tx in self.unconfirmed_transactions
-            if tx.trans_id not in {t.trans_id for t in block.transactions}
-        ]
\ No newline at end of file
+        numbers = set(tx.number for tx in block.transactions)
+        self.mempool.remove(numbers)
+        pending = self._pending_txs
+        kept = 0
+        while kept < len(pending) and pending[kept].number not in numbers:
+            kept += 1
+        if kept < len(pending):
+            # The pending transactions before the first confirmed one stay in
+            # front of the mempool, so their leaves are kept
+            self._pending_tree.truncate(kept)
+            self._pending_txs = self.mempool.head(Blockchain.block_size)
\ No newline at end of file
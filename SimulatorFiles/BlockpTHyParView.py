@@ -1,5 +1,6 @@
 from Blockchain import * 
-from simian import Simian
+from Messages import ReceivedMessages
+from simian import Simian, LOG_DEBUG
 import random, math, argparse
 
 parser = argparse.ArgumentParser(
@@ -14,6 +15,26 @@ parser.add_argument("-l", "--lookahead", type=float, metavar='LOOKAHEAD', defaul
                     help="min delay of mailboxes -> default 0.1")
 parser.add_argument("--useMPI", type=int, metavar='MPI', default=0,
                     help="use mpi -> 0-false  1-true")
+parser.add_argument("--scheduler", type=str, metavar='SCHEDULER', default="heap", choices=["heap", "ladder"],
+                    help="event queue of the engine -> heap or ladder, default heap")
+parser.add_argument("--batchEvents", type=int, metavar='BATCH', default=0,
+                    help="drain events with the same timestamp in one pass -> 0-false  1-true")
+parser.add_argument("--workers", type=int, metavar='WORKERS', default=1,
+                    help="number of local worker processes, a shared-memory alternative to --useMPI; results differ from a single process, as every worker has its own random stream and upNodes -> default 1")
+parser.add_argument("--modelledPoW", type=int, metavar='MODELLED', default=0,
+                    help="give mined blocks a cheap stand-in hash instead of searching a real proof of work -> 0-false  1-true")
+parser.add_argument("--maxOrphans", type=int, metavar='ORPHANS', default=4096,
+                    help="blocks a node keeps waiting for a missing parent, the highest ones are dropped first -> default 4096")
+parser.add_argument("--auditChains", type=int, metavar='AUDIT', default=0,
+                    help="validate the chain of every node at the end of the run -> 0-false  1-true")
+parser.add_argument("--retention", type=float, metavar='RETENTION', default=0,
+                    help="seconds after which a node forgets a received message, keeping only its report counters -> 0 keeps every message, default 0")
+parser.add_argument("--logLevel", type=int, metavar='LEVEL', default=1,
+                    help="detail of the .out files -> 1-reports  2-entity placement  3-protocol traces, default 1")
+parser.add_argument("--declareLookahead", type=int, metavar='DECLARE', default=0,
+                    help="declare the message lookahead to the engine, so parallel runs synchronize once per lookahead instead of once per minDelay; changes the model, as transaction and churn delays are then drawn no smaller than the lookahead -> 0-false  1-true")
+parser.add_argument("--repartition", type=float, metavar='INTERVAL', default=0,
+                    help="re-place Node entities on ranks by a min-cut partition of the overlay every INTERVAL time units -> default 0 (round-robin placement)")
 parser.add_argument("--seedR", type=int, metavar='SEED', default=10,
                     help="seed for random number generation -> default 10")
 parser.add_argument("--updateViews", type=float, metavar='TIME', default=5,
@@ -35,6 +56,10 @@ parser.add_argument("--prwl", type=int, metavar='PRWL', default=3,
                     help="passive random walk length -> default 3")
 args = parser.parse_args()
 
+Blockchain.modelled_pow = args.modelledPoW == 1
+Blockchain.max_orphans = args.maxOrphans
+auditChains = args.auditChains == 1
+
 uMPI = False
 if args.useMPI == 1:
     uMPI = True
@@ -51,6 +76,7 @@ threshold = 3
 
 timerPTacks = 2.5
 failRate = args.failRate
+retention = args.retention
 delayLazy = 1
 stabilizationTime = 49 #args.endtime
 
@@ -71,7 +97,12 @@ upNodes = []
 name = "PlumTreeHyParView/PlumTree + HyParView" + str(args.total_nodes)+'-Update'+str(args.updateViews)+'-View'+str(args.c)+'-LOOKAHEAD'+str(args.lookahead) +'-CHURN'+str(args.activeChurn)
 
 simName, startTime, endTime, minDelay, useMPI, mpiLib = name, 0, args.endtime, 0.00001, uMPI, "/usr/lib/x86_64-linux-gnu/libmpich.so"
-simianEngine = Simian(simName, startTime, endTime, minDelay, useMPI)
+#Smallest delay of any message between entities. The transaction and churn delays are
+#exponential and have no lower bound, so they are drawn no smaller than this: with
+#--declareLookahead 1 the samples below the lookahead are raised to it, which changes the
+#timing and the event count of the run. Compare such runs only with runs using the flag.
+sendDelay = lookahead / 4 if args.declareLookahead == 1 else minDelay
+simianEngine = Simian(simName, startTime, endTime, minDelay, useMPI, scheduler=args.scheduler, bucketWidth=lookahead, batchEvents=args.batchEvents == 1, workers=args.workers, logLevel=args.logLevel)
 
 # # Init grid
 # positions = []
@@ -134,7 +165,7 @@ class ChurnManager(simianEngine.Entity):
         if len(upNodes) > churn_size:
             to_churn = random.sample(upNodes, churn_size)
             for node_id in to_churn:
-                delay = random.expovariate(1/20)
+                delay = max(random.expovariate(1/20), sendDelay)
                 self.reqService(delay, "force_churn_out", "", "Node", node_id)
 
 class ReportNode(simianEngine.Entity):
@@ -148,8 +179,9 @@ class ReportNode(simianEngine.Entity):
         self.degree = 0
         self.totalMiners = 0
         self.totalTransactions = 0 
-        self.longestChain = []
+        self.longestChain = 0
         self.chainLenghts = 0
+        self.tips = []
         self.maxDegree = 0
         self.minDegree = 1000
         self.shortestPath = 0
@@ -160,8 +192,10 @@ class ReportNode(simianEngine.Entity):
         payload = args[0]
         msg = payload[0]
         trx = payload[1]
-        chain = payload[2]
+        chainLength = payload[2]
         ifminer = payload[3]
+        if payload[4] is not None:
+            self.tips.append(payload[4])
 
         if msg.degree > self.maxDegree:
             self.maxDegree = msg.degree
@@ -187,10 +221,10 @@ class ReportNode(simianEngine.Entity):
         
         self.totalTransactions += trx
 
-        if len(self.longestChain) < len(chain):
-            self.longestChain = chain
+        if self.longestChain < chainLength:
+            self.longestChain = chainLength
         
-        self.chainLenghts += len(chain)
+        self.chainLenghts += chainLength
         
         if ifminer : self.totalMiners += 1
 
@@ -250,12 +284,15 @@ class ReportNode(simianEngine.Entity):
             self.shortestPath /= msgs
             self.shortestPath /= (nodes * (1-failRate))
             average_length = self.chainLenghts / (nodes * (1-failRate))
-            avChainL = average_length /  len(self.longestChain) * 100
+            avChainL = average_length /  self.longestChain * 100
 
 
-            self.out.write("Number of Miners:%d   Total Transactions:%d    Longest Chain:%d     Avarage Chain lenght:%f\n"%(self.totalMiners,self.totalTransactions,len(self.longestChain),avChainL))
+            self.out.write("Number of Miners:%d   Total Transactions:%d    Longest Chain:%d     Avarage Chain lenght:%f\n"%(self.totalMiners,self.totalTransactions,self.longestChain,avChainL))
             self.out.write("AVERAGE--Reliability:%.3f%%    Nodes:%d    Latency:%.1f   RMR:%.3f        Gossip:%d   Ihave:%d   Graft:%d\n\n"%(avRel,avNodes,avLat,avRmr,avGossip,avIhave,avGraft))
         self.out.write("Degree:%.2f  min:%d    max:%d    shortest path:%.2f\n"%(degree,self.minDegree,self.maxDegree,self.shortestPath))
+        if auditChains:
+            valid = Blockchain.validate_many(self.tips)
+            self.out.write("Audited chains:%d   Valid:%d\n"%(len(valid),sum(valid)))
         
 
 class Node(simianEngine.Entity):
@@ -276,10 +313,9 @@ class Node(simianEngine.Entity):
         self.lazyPushPeers = []
         self.lazyQueues = []
         self.missing = []
-        self.receivedMsgs = {}
+        self.receivedMsgs = ReceivedMessages(retention, endTime - 1)
         self.timers = []
 
-        self.report = {}
         self.timersAck = {}
 
         #hyparview variables
@@ -340,10 +376,7 @@ class Node(simianEngine.Entity):
                 msgToSend = msgGossip('ACK','','',msg.ID,msg.round,self.node_idx)
                 self.reqService(lookahead, "PlumTreeGossip", msgToSend, "Node", msg.sender)
 
-                if msg.ID not in self.report.keys():
-                    self.report[msg.ID] = [0,1,0]
-                else:
-                    self.report[msg.ID][1] += 1
+                self.receivedMsgs.count(msg.ID, 1, self.engine.now)
 
                 if msg.ID not in self.receivedMsgs.keys():
                     self.missing.append((msg.ID,msg.sender,msg.round))
@@ -353,36 +386,32 @@ class Node(simianEngine.Entity):
                         self.reqService(timeout1, "Timer", msg.ID)
 
             elif msg.type =='GRAFT':
-                if msg.ID not in self.report.keys():
-                    self.report[msg.ID] = [0,0,1]
-                else:
-                    self.report[msg.ID][2] += 1
+                self.receivedMsgs.count(msg.ID, 2, self.engine.now)
 
                 if msg.sender not in self.eagerPushPeers and msg.sender in self.activeView:
                     self.eagerPushPeers.append(msg.sender)
                 if msg.sender in self.lazyPushPeers:
                     self.lazyPushPeers.remove(msg.sender)
                 if msg.ID in self.receivedMsgs.keys():
-                    msgToSend = msgGossip('GOSSIP',self.receivedMsgs[msg.ID].payloadType,self.receivedMsgs[msg.ID].payload,msg.ID,msg.round,self.node_idx)
+                    payloadType, payload = self.receivedMsgs.payload(msg.ID)
+                    msgToSend = msgGossip('GOSSIP',payloadType,payload,msg.ID,msg.round,self.node_idx)
                     self.reqService(lookahead, "PlumTreeGossip", msgToSend, "Node", msg.sender)
 
             elif msg.type =='GOSSIP':
-                if msg.ID not in self.report.keys():
-                    self.report[msg.ID] = [1,0,0]
-                else:
-                    self.report[msg.ID][0] += 1
+                self.receivedMsgs.count(msg.ID, 0, self.engine.now)
 
                 if msg.ID not in self.receivedMsgs.keys():
                     msgToSend = msgGossip('ACK','','',msg.ID,msg.round,self.node_idx)
                     self.reqService(lookahead, "PlumTreeGossip", msgToSend, "Node", msg.sender)
 
-                    self.receivedMsgs[msg.ID] = msg
+                    self.receivedMsgs.add(msg.ID, msg.payloadType, msg.payload, msg.round, self.engine.now)
+                    self.receivedMsgs.expire_old(self.engine.now)
                     
                     if msg.ID in self.timers:
                         self.timers.remove(msg.ID)
 
                     if msg.payloadType  == "BLOCK":
-                        block = Block.from_dict(msg.payload)
+                        block = shared_block(msg.payload)
                         accepted = self.blockchain.consensus(block)
                         if accepted:
                             self.blockchain.remove_confirmed_transactions(block)
@@ -395,7 +424,7 @@ class Node(simianEngine.Entity):
                     elif msg.payloadType  == "TRX":
                         if self.miner:
                             self.blockchain.add_new_transaction(msg.payload)
-                            if self.miner and not self.mining and len(self.blockchain.unconfirmed_transactions) >= 100:
+                            if self.miner and not self.mining and len(self.blockchain.mempool) >= 100:
                                 self.mining = True
                                 avg_mining_time = 30
                                 delay = random.expovariate(1/avg_mining_time)
@@ -422,8 +451,7 @@ class Node(simianEngine.Entity):
                 msg.type = 'GOSSIP'
                 self.EagerPush(msg)
                 self.LazyPush(msg)
-                self.receivedMsgs[mID] = msg
-                self.report[msg.ID] = [0,0,0]
+                self.receivedMsgs.add(mID, msg.payloadType, msg.payload, msg.round, self.engine.now, [0, 0, 0])
 
             elif msg.type =='ACK':
                 #remover lista de timers
@@ -441,9 +469,8 @@ class Node(simianEngine.Entity):
         self.blockchain.mine()
         new_block = self.blockchain.last_block
         block_id = "B-" +str(random.randint(11111111,99999999))
-        block_msg = msgGossip('GOSSIP',"BLOCK", new_block.to_dict(), block_id, 0, self.node_idx)        
-        self.receivedMsgs[block_msg.ID] = block_msg
-        self.report[block_msg.ID] = [1, 0, 0]
+        block_msg = msgGossip('GOSSIP',"BLOCK", new_block, block_id, 0, self.node_idx)        
+        self.receivedMsgs.add(block_msg.ID, block_msg.payloadType, block_msg.payload, block_msg.round, self.engine.now, [1, 0, 0])
         self.LazyPush(block_msg)
         self.EagerPush(block_msg)
         self.mining = False
@@ -451,26 +478,26 @@ class Node(simianEngine.Entity):
     def EagerPush(self, msg):
         sender = msg.sender
         msgToSend = msgGossip('GOSSIP',msg.payloadType ,msg.payload,msg.ID,msg.round + 1,self.node_idx)        
-        for n in self.eagerPushPeers:
-            if n != sender:
-                #create timer to receive ack
-                if n not in self.timersAck.keys():
-                    self.timersAck[n] = []
-                self.timersAck[n].append((msg.ID, msg.round + 1))
-                self.reqService(lookahead * timerPTacks, "TimerAcks", (n, msg.ID, msg.round + 1))
-                self.reqService(lookahead, "PlumTreeGossip", msgToSend, "Node", n)
+        peers = [n for n in self.eagerPushPeers if n != sender]
+        for n in peers:
+            #create timer to receive ack
+            if n not in self.timersAck.keys():
+                self.timersAck[n] = []
+            self.timersAck[n].append((msg.ID, msg.round + 1))
+            self.reqService(lookahead * timerPTacks, "TimerAcks", (n, msg.ID, msg.round + 1))
+        self.reqServiceMulti(lookahead, "PlumTreeGossip", msgToSend, "Node", peers)
 
     def LazyPush(self, msg):
         sender = msg.sender
         msgToSend = msgGossip('IHAVE','',msg.payload,msg.ID,msg.round + 1,self.node_idx)
-        for n in self.lazyPushPeers:
-            if n != sender:
-                #create timer to receive ack
-                if n not in self.timersAck.keys():
-                    self.timersAck[n] = []
-                self.timersAck[n].append((msg.ID, msg.round + 1))
-                self.reqService(lookahead * delayLazy * timerPTacks, "TimerAcks", (n, msg.ID, msg.round + 1))
-                self.reqService(lookahead * delayLazy, "PlumTreeGossip", msgToSend, "Node", n)
+        peers = [n for n in self.lazyPushPeers if n != sender]
+        for n in peers:
+            #create timer to receive ack
+            if n not in self.timersAck.keys():
+                self.timersAck[n] = []
+            self.timersAck[n].append((msg.ID, msg.round + 1))
+            self.reqService(lookahead * delayLazy * timerPTacks, "TimerAcks", (n, msg.ID, msg.round + 1))
+        self.reqServiceMulti(lookahead * delayLazy, "PlumTreeGossip", msgToSend, "Node", peers)
 
     def Optimization(self, mID, round, sender):
         val = True
@@ -549,10 +576,8 @@ class Node(simianEngine.Entity):
                 newNode = msg.sender
                 self.activeView.append(newNode)
                 self.eagerPushPeers.append(newNode)
-                for n in self.activeView:
-                    if n != newNode:
-                        msgToSend = msgHPV('FORWARDJOIN',newNode,ARWL,self.node_idx)
-                        self.reqService(lookahead, "HyParView", msgToSend, "Node", n)
+                msgToSend = msgHPV('FORWARDJOIN',newNode,ARWL,self.node_idx)
+                self.reqServiceMulti(lookahead, "HyParView", msgToSend, "Node", [n for n in self.activeView if n != newNode])
 
             elif msg.type =='FORWARDJOIN':
                 if msg.timeToLive == 0 or len(self.activeView) <= 1:
@@ -568,9 +593,9 @@ class Node(simianEngine.Entity):
                     idx = random.randrange(len(available))
                     n = available[idx]
 
-                    msg.timeToLive -= 1
-                    msg.sender = self.node_idx
-                    self.reqService(lookahead, "HyParView", msg, "Node", n)
+                    #msg is shared by all receivers of the JOIN fan-out, so forward a copy
+                    msgToSend = msgHPV('FORWARDJOIN',msg.newNode,msg.timeToLive - 1,self.node_idx)
+                    self.reqService(lookahead, "HyParView", msgToSend, "Node", n)
 
 
             elif msg.type =='DISCONNECT':
@@ -792,19 +817,18 @@ class Node(simianEngine.Entity):
              self.reqService(5, "TriggerPassiveViewMaintain", "none")
 
     def TriggerSystemReport(self,*args):
-        report = []
+        report = self.receivedMsgs.report_entries()
         degree = len(self.eagerPushPeers)+len(self.lazyPushPeers)
-        for m in self.receivedMsgs.keys():
-            report.append((m,self.receivedMsgs[m].round,self.report[m][0],self.report[m][1],self.report[m][2]))
         msgToSend = msgReport('reply',report,degree)
-        self.reqService(lookahead, "SystemReport", [msgToSend, self.trxMade , self.blockchain.chain, self.miner] , "ReportNode", 0)
+        self.reqService(lookahead, "SystemReport", [msgToSend, self.trxMade , self.blockchain.chain_length(), self.miner,
+                        self.blockchain.best if auditChains else None] , "ReportNode", 0)
 
     def printViews(self, *args):
         res = ''
         # for m in self.receivedMsgs.keys():
         #     res += self.receivedMsgs[m].toString() + " "
         if self.active:
-            self.out.write("%d:Peers %s %s %s msg %s\n"%(self.node_idx,str(self.activeView),str(self.passiveView),str(self.neighborQueue),res))
+            self.out.write("%d:Peers %s %s %s msg %s\n"%(self.node_idx,str(self.activeView),str(self.passiveView),str(self.neighborQueue),res), LOG_DEBUG)
 
     def BecomeMiner(self, *args):
         self.miner = True
@@ -813,11 +837,8 @@ class Node(simianEngine.Entity):
         if self.active:
             self.active = False
             self.peers = []
-            self.blockchain.chain = []
-            self.blockchain.forks = {}
-            self.blockchain.orphans = []
-            self.receivedMsgs = {}
-            self.report = {}
+            self.blockchain.clear()
+            self.receivedMsgs.clear()
 
             if self.node_idx in upNodes:
                 upNodes.remove(self.node_idx)
@@ -827,7 +848,7 @@ class Node(simianEngine.Entity):
     def create_transaction(self,*args):
         n = random.choice(upNodes)
         avg_transactionT = .7
-        delay = random.expovariate(1/avg_transactionT)
+        delay = max(random.expovariate(1/avg_transactionT), sendDelay)
         if self.active and not self.miner:
             transaction = Transaction(self.node_idx)
             tx_msg = msgGossip('BROADCAST',"TRX", transaction, transaction.trans_id, 0, self.node_idx)
@@ -838,6 +859,13 @@ class Node(simianEngine.Entity):
             self.reqService(delay , "create_transaction", "" , "Node", n)
 
 
+if args.declareLookahead == 1:
+    for entityName in ("Node", "ReportNode", "ChurnManager"):
+        simianEngine.setLookahead(entityName, sendDelay)
+
+if args.repartition > 0:
+    simianEngine.setPartitioner("Node", lambda node: node.eagerPushPeers + node.lazyPushPeers, args.repartition)
+
 for i in range(0, nodes):
     simianEngine.addEntity("Node", Node, i, i, nodes)
 
@@ -0,0 +1,160 @@
+from array import array
+from collections import deque
+
+
+class PayloadStore:
+    """
+    Payloads of the gossip messages held by the nodes of this process, by
+    message id, with the number of nodes holding each. A payload is dropped
+    when the last node holding it releases it.
+    """
+    def __init__(self):
+        # msg_id -> [payload_type, payload, holders]
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hold(self, msg_id, payload_type, payload):
+        entry = self.entries.get(msg_id)
+        if entry is None:
+            self.entries[msg_id] = [payload_type, payload, 1]
+        else:
+            entry[2] += 1
+
+    def get(self, msg_id):
+        entry = self.entries[msg_id]
+        return entry[0], entry[1]
+
+    def release(self, msg_id):
+        entry = self.entries[msg_id]
+        entry[2] -= 1
+        if entry[2] == 0:
+            del self.entries[msg_id]
+
+
+payload_store = PayloadStore()
+
+
+class ReceivedMessages:
+    """
+    The gossip message state of a node: message id -> round of the messages
+    it received, with the payloads kept once per process in payload_store,
+    and the report counters [gossip, ihave, graft] of every message id the
+    node has seen, received or only announced. Iterating, len() and `in`
+    work on the received message ids, like the dict of messages it replaces.
+
+    With a retention window, ids first seen more than retention ago are
+    forgotten by expire_old(). The report entries of the received ones are
+    kept in compact columns until the node reports them, and go away with
+    the rest of the node's state in clear().
+    """
+    def __init__(self, retention=0, until=float("inf")):
+        self.retention = retention
+        # No expiry from this time on, e.g. once the node has reported
+        self.until = until
+        self.rounds = {}
+        self.counters = {}
+        # (time, msg_id) in the order the ids were first seen, for expire()
+        self.arrivals = deque()
+        # Report entries of the expired messages: their ids, and round,
+        # gossip, ihave and graft four by four
+        self.expired_ids = []
+        self.expired = array("q")
+
+    def __len__(self):
+        return len(self.rounds)
+
+    def __contains__(self, msg_id):
+        return msg_id in self.rounds
+
+    def __iter__(self):
+        return iter(self.rounds)
+
+    def keys(self):
+        return self.rounds.keys()
+
+    def _track(self, msg_id, time):
+        counters = self.counters.get(msg_id)
+        if counters is None:
+            counters = self.counters[msg_id] = [0, 0, 0]
+            self.arrivals.append((time, msg_id))
+        return counters
+
+    def add(self, msg_id, payload_type, payload, round, time=0, counters=None):
+        """Store a received message, setting its report counters if given."""
+        self._track(msg_id, time)
+        if counters is not None:
+            self.counters[msg_id] = counters
+        if msg_id not in self.rounds:
+            payload_store.hold(msg_id, payload_type, payload)
+        self.rounds[msg_id] = round
+
+    def count(self, msg_id, column, time=0):
+        """Add one to a report counter: column 0 gossip, 1 ihave, 2 graft."""
+        self._track(msg_id, time)[column] += 1
+
+    def report(self, msg_id):
+        """The [gossip, ihave, graft] counters of a message id."""
+        return self.counters[msg_id]
+
+    def expire(self, before):
+        """
+        Forget the message ids first seen before the given time. The report
+        entries of those that were received are kept (see report_entries);
+        the counters of ids never received are not reported and are dropped.
+        """
+        arrivals = self.arrivals
+        while arrivals and arrivals[0][0] < before:
+            msg_id = arrivals.popleft()[1]
+            counters = self.counters.pop(msg_id)
+            if msg_id in self.rounds:
+                self.expired_ids.append(msg_id)
+                self.expired.extend((self.rounds.pop(msg_id), counters[0], counters[1], counters[2]))
+                payload_store.release(msg_id)
+
+    def expire_old(self, now):
+        """Expire the ids first seen more than retention before now, if retention is set."""
+        if self.retention > 0 and now < self.until:
+            self.expire(now - self.retention)
+
+    def report_entries(self):
+        """(msg_id, round, gossip, ihave, graft) of every received message, expired or not."""
+        entries = []
+        for msg_id, round in self.rounds.items():
+            counters = self.counters[msg_id]
+            entries.append((msg_id, round, counters[0], counters[1], counters[2]))
+        expired = self.expired
+        for i, msg_id in enumerate(self.expired_ids):
+            entries.append((msg_id,) + tuple(expired[4 * i:4 * i + 4]))
+        return entries
+
+    def round(self, msg_id):
+        return self.rounds[msg_id]
+
+    def payload(self, msg_id):
+        """(payload_type, payload) of a received message."""
+        return payload_store.get(msg_id)
+
+    def clear(self):
+        for msg_id in self.rounds:
+            payload_store.release(msg_id)
+        self.rounds = {}
+        self.counters = {}
+        self.arrivals = deque()
+        self.expired_ids = []
+        self.expired = array("q")
+
+    def __del__(self):
+        self.clear()
+
+    def __getstate__(self):
+        # A node migrating to another process takes the payloads it holds
+        state = self.__dict__.copy()
+        state["payloads"] = {msg_id: payload_store.get(msg_id) for msg_id in self.rounds}
+        return state
+
+    def __setstate__(self, state):
+        for msg_id, (payload_type, payload) in state.pop("payloads").items():
+            payload_store.hold(msg_id, payload_type, payload)
+        self.__dict__.update(state)
@@ -0,0 +1,118 @@
+from array import array
+import math
+
+
+class GridIndex:
+    """
+    Uniform grid over 2-D points with cells as wide as the query radius, so
+    a radius query only looks at the 3x3 cells around the point instead of
+    every other point.
+    """
+    def __init__(self, points, radius):
+        self.points = points
+        self.radius = radius
+        self.cells = {}
+        for i, (x, y) in enumerate(points):
+            self.cells.setdefault((math.floor(x / radius), math.floor(y / radius)), []).append(i)
+
+    def neighbours(self, index):
+        """Indices of the points closer than radius to points[index], in increasing order."""
+        point = self.points[index]
+        cx = math.floor(point[0] / self.radius)
+        cy = math.floor(point[1] / self.radius)
+        found = []
+        for x in (cx - 1, cx, cx + 1):
+            for y in (cy - 1, cy, cy + 1):
+                for i in self.cells.get((x, y), ()):
+                    if i != index and math.dist(point, self.points[i]) < self.radius:
+                        found.append(i)
+        found.sort()
+        return found
+
+
+class Topology:
+    """
+    Node positions and radius-neighbour adjacency in CSR form: the
+    neighbours of node i are indices[indptr[i]:indptr[i + 1]], in increasing
+    order. Built once by build_topology and shared by all the nodes.
+    """
+    def __init__(self, positions, indptr, indices):
+        self.positions = positions
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.positions)
+
+    def neighbours(self, index):
+        """A new list of the neighbours of node index."""
+        return self.indices[self.indptr[index]:self.indptr[index + 1]].tolist()
+
+
+def build_topology(nodes, columns, spacing, radius, jitter, rng, origin=50):
+    """
+    Place nodes row by row on a grid of the given columns and spacing, each
+    moved by a uniform jitter in x and y, and link the nodes closer than
+    radius. The jitter is drawn from rng (random.Random or the seeded random
+    module), x then y for each node, so a seed always gives the same
+    topology. With NumPy the placement and the neighbour search are
+    vectorized; without it the search goes through a GridIndex.
+    """
+    offsets = [rng.uniform(-jitter, jitter) for i in range(2 * nodes)]
+    try:
+        import numpy as np
+    except ImportError:
+        positions = [(origin + (i % columns) * spacing + offsets[2 * i],
+                      origin + (i // columns) * spacing + offsets[2 * i + 1]) for i in range(nodes)]
+        grid = GridIndex(positions, radius)
+        indptr = array("q", [0])
+        indices = array("q")
+        for i in range(nodes):
+            indices.extend(grid.neighbours(i))
+            indptr.append(len(indices))
+        return Topology(positions, indptr, indices)
+
+    offsets = np.array(offsets, dtype=np.float64).reshape(nodes, 2)
+    ids = np.arange(nodes, dtype=np.int64)
+    xs = origin + (ids % columns) * spacing + offsets[:, 0]
+    ys = origin + (ids // columns) * spacing + offsets[:, 1]
+    indptr, indices = _radius_csr(np, xs, ys, radius)
+    return Topology(list(zip(xs.tolist(), ys.tolist())), indptr, indices)
+
+
+def _radius_csr(np, xs, ys, radius):
+    """CSR (indptr, indices) of the point pairs closer than radius, by grid cells."""
+    nodes = len(xs)
+    # Cell coordinates start at 1 and rows are 2 cells wider than needed,
+    # so the cells around a point never wrap into another row
+    cx = np.floor(xs / radius).astype(np.int64)
+    cy = np.floor(ys / radius).astype(np.int64)
+    cx -= cx.min() - 1
+    cy -= cy.min() - 1
+    width = cx.max() + 2
+    cells = cy * width + cx
+    order = np.argsort(cells, kind="stable")
+    sorted_cells = cells[order]
+
+    rows = []
+    cols = []
+    ids = np.arange(nodes, dtype=np.int64)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            # Every point against every point of the cell at (dx, dy)
+            target = cells + dy * width + dx
+            start = np.searchsorted(sorted_cells, target, side="left")
+            counts = np.searchsorted(sorted_cells, target, side="right") - start
+            src = np.repeat(ids, counts)
+            within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            dst = order[np.repeat(start, counts) + within]
+            keep = (src != dst) & (np.hypot(xs[src] - xs[dst], ys[src] - ys[dst]) < radius)
+            rows.append(src[keep])
+            cols.append(dst[keep])
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    by_row = np.lexsort((cols, rows))
+    indptr = np.zeros(nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=nodes), out=indptr[1:])
+    return indptr, cols[by_row]
@@ -0,0 +1,73 @@
+# Micro-benchmark of the per-event service dispatch in Simian.run().
+# It times the lookup step on its own, comparing getattr(entities[rx][rxId], name)
+# with the cached entity._dispatch[sid] list used by the engine. It then times the
+# whole engine loop per event, where every service only forwards one event to the
+# next entity with a fixed delay, as the protocol drivers do with their lookahead.
+#
+#   python benchmarks/benchDispatch.py 15000 --events 1000000
+import argparse, os, random, sys, tempfile, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from simian import Simian, perfTime
+
+parser = argparse.ArgumentParser(
+    description='Service dispatch micro-benchmark.',
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('total_nodes', metavar='NNODES', type=int, nargs='?', default=15000,
+                    help='number of entities -> default 15000')
+parser.add_argument("--events", type=int, metavar='EVENTS', default=1000000,
+                    help="number of events to dispatch -> default 1000000")
+parser.add_argument("--seedR", type=int, metavar='SEED', default=10,
+                    help="seed for random number generation -> default 10")
+args = parser.parse_args()
+
+random.seed(args.seedR)
+nodes = args.total_nodes
+lookahead = 0.001
+services = ["PlumTreeGossip", "HyParView", "TimerAcks", "Timer"]
+endTime = lookahead * args.events / nodes
+scratch = tempfile.mkdtemp()
+simianEngine = Simian(os.path.join(scratch, "benchDispatch"), 0, endTime, lookahead, False, silent=True)
+
+class Node(simianEngine.Entity):
+    def __init__(self, baseInfo, *args):
+        super(Node, self).__init__(baseInfo)
+        self.next = (self.num + 1) % nodes
+
+    def PlumTreeGossip(self, *args): self.reqService(lookahead, "HyParView", None, "Node", self.next)
+    def HyParView(self, *args): self.reqService(lookahead, "TimerAcks", None, "Node", self.next)
+    def TimerAcks(self, *args): self.reqService(lookahead, "Timer", None, "Node", self.next)
+    def Timer(self, *args): self.reqService(lookahead, "PlumTreeGossip", None, "Node", self.next)
+
+for i in range(nodes):
+    simianEngine.addEntity("Node", Node, i)
+
+# Lookup step only, on already warm caches
+entities = simianEngine.entities
+sample = [(random.randrange(nodes), random.choice(services)) for _ in range(1000)]
+sample = [("Node", i, name, simianEngine.getServiceId(name)) for i, name in sample]
+for rx, rxId, name, sid in sample:
+    entities[rx][rxId]._bindService(sid)
+
+def byName():
+    for rx, rxId, name, sid in sample:
+        getattr(entities[rx][rxId], name)
+
+def byId():
+    for rx, rxId, name, sid in sample:
+        entities[rx][rxId]._dispatch[sid]
+
+loops = max(1, args.events // len(sample))
+for label, fun in [("getattr by name", byName), ("cached by id", byId)]:
+    t = min(timeit.repeat(fun, number=loops, repeat=3))
+    print("%-16s %7.1f ns/event" % (label, t / (loops * len(sample)) * 1e9))
+
+# Whole engine loop, one event in flight per entity
+for i in range(nodes):
+    simianEngine.schedService(lookahead, random.choice(services), None, "Node", i)
+start = perfTime()
+simianEngine.run()
+elapsed = perfTime() - start
+simianEngine.exit()
+print("%-16s %7.1f ns/event (%d events, incl. one reqService each)" % ("engine loop", elapsed / args.events * 1e9, args.events))
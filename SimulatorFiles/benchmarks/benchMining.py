@@ -0,0 +1,70 @@
+# Hashes per second of the proof-of-work loops in Blockchain.py, on one block of
+# NTXS transactions. Every loop tries the same number of nonces against a target
+# that nothing meets, so all of them do the same work:
+#   json      one nonce at a time, JSON-serializing the whole block (the original loop)
+#   header    one nonce at a time with Block.compute_hash() (cached binary header)
+#   midstate  scan_nonces() in this process
+#   pool      scan_nonces() over Blockchain.mining_workers processes
+#
+#   python benchmarks/benchMining.py 100 --nonces 200000 --workers 4
+import argparse, json, os, random, sys
+from hashlib import sha256
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Blockchain import Block, Blockchain, Transaction, scan_nonces, _get_mining_pool
+from simian import perfTime
+
+parser = argparse.ArgumentParser(
+    description='Proof-of-work hashing benchmark.',
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('total_txs', metavar='NTXS', type=int, nargs='?', default=100,
+                    help='transactions in the block -> default 100')
+parser.add_argument("--nonces", type=int, metavar='NONCES', default=200000,
+                    help="nonces tried by the fast loops, the json loop tries 1/100 of them -> default 200000")
+parser.add_argument("--workers", type=int, metavar='WORKERS', default=os.cpu_count(),
+                    help="processes of the pool loop -> default: number of CPUs")
+parser.add_argument("--seedR", type=int, metavar='SEED', default=10,
+                    help="seed for random number generation -> default 10")
+args = parser.parse_args()
+
+random.seed(args.seedR)
+block = Block(1, [Transaction(i) for i in range(args.total_txs)], 0.0, sha256(b"previous").hexdigest())
+never = bytes(32)
+
+def jsonLoop(count):
+    for nonce in range(count):
+        content = {
+            "index": block.index,
+            "transactions": [tx.to_dict() for tx in block.transactions],
+            "timestamp": block.timestamp,
+            "previous_hash": block.previous_hash,
+            "nonce": nonce
+        }
+        sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def headerLoop(count):
+    for nonce in range(count):
+        block.nonce = nonce
+        block.compute_hash().startswith('0' * 64)
+
+def midstateLoop(count):
+    scan_nonces(block.header_prefix(), 0, count, never)
+
+def poolLoop(count):
+    pool = _get_mining_pool(args.workers)
+    batch = -(-count // args.workers)
+    starts = [i * batch for i in range(args.workers)]
+    list(pool.map(scan_nonces, [block.header_prefix()] * args.workers, starts,
+                  [s + batch for s in starts], [never] * args.workers))
+
+_get_mining_pool(args.workers).submit(int).result() # Start the processes before timing
+print("%d transactions, %d pool workers" % (args.total_txs, args.workers))
+for name, loop, count in (("json", jsonLoop, max(args.nonces // 100, 1)),
+                          ("header", headerLoop, args.nonces),
+                          ("midstate", midstateLoop, args.nonces),
+                          ("pool", poolLoop, args.nonces)):
+    start = perfTime()
+    loop(count)
+    elapsed = perfTime() - start
+    print("%-9s %12.0f hashes/s" % (name, count / elapsed))
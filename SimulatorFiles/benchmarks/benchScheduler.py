@@ -0,0 +1,48 @@
+# Compares the Simian event queues (heap vs ladder) on the LazyPush and
+# PlumTree + HyParView workloads. Every driver is run once per scheduler inside
+# a scratch directory, so no result files are written next to the drivers, and
+# the wall-clock time and events per second reported by the engine are printed.
+#
+#   python benchmarks/benchScheduler.py 5000 200 -l 0.001 --seedR 978
+import argparse, os, re, subprocess, sys, tempfile
+
+parser = argparse.ArgumentParser(
+    description='Event queue benchmark.',
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+parser.add_argument('total_nodes', metavar='NNODES', type=int, nargs='?', default=1000,
+                    help='total number of nodes -> default 1000')
+parser.add_argument('endtime', metavar='ENDTIME', type=float, nargs='?', default=200,
+                    help='simulation end time -> default 200')
+parser.add_argument("-l", "--lookahead", type=float, metavar='LOOKAHEAD', default=0.001,
+                    help="min delay of mailboxes -> default 0.001")
+parser.add_argument("--seedR", type=int, metavar='SEED', default=978,
+                    help="seed for random number generation -> default 978")
+parser.add_argument("--schedulers", type=str, metavar='LIST', default="heap,ladder",
+                    help="comma separated schedulers to compare -> default heap,ladder")
+args = parser.parse_args()
+
+simDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+workloads = [
+    ("LazyPush", "BlockLazyPush.py", "LazyPushSimulation"),
+    ("HyParView", "BlockpTHyParView.py", "PlumTreeHyParView"),
+]
+
+def runDriver(script, outDir, scheduler):
+    with tempfile.TemporaryDirectory() as scratch:
+        os.mkdir(os.path.join(scratch, outDir))
+        cmd = [sys.executable, os.path.join(simDir, script), str(args.total_nodes), str(args.endtime),
+               "-l", str(args.lookahead), "--seedR", str(args.seedR), "--scheduler", scheduler]
+        res = subprocess.run(cmd, cwd=scratch, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    elapsed = float(re.search(r"COMPLETED IN: ([0-9.e+-]+)", res.stdout).group(1))
+    events = int(re.search(r"SIMULATED EVENTS: (\d+)", res.stdout).group(1))
+    return elapsed, events
+
+print("%-10s %-8s %12s %10s %14s" % ("workload", "queue", "events", "time(s)", "events/s"))
+for label, script, outDir in workloads:
+    base = None
+    for scheduler in args.schedulers.split(","):
+        elapsed, events = runDriver(script, outDir, scheduler)
+        if base is None: base = elapsed
+        print("%-10s %-8s %12d %10.2f %14.0f   x%.2f" % (label, scheduler, events, elapsed, events / elapsed, base / elapsed))
+    sys.stdout.flush()
@@ -56,7 +56,7 @@
 
 from __future__ import print_function
 import os, sys
-import hashlib, heapq
+import hashlib, heapq, bisect, math
 import time as timeLib
 import types #Used to bind Service at runtime to specific instances
 import ctypes as C #For FFI of MPICH
@@ -82,6 +82,29 @@ class SimianError(Exception):
     def __str__(self): return self.value
 #===========================================================================================
 
+#===========================================================================================
+# log.py
+# Output file of a rank. Every line has a level and is only written if the log's level is at
+# least as high; plain write(text) is a report, which is kept at the default level.
+#===========================================================================================
+LOG_REPORT = 1 #Results and summaries
+LOG_INFO = 2 #Engine chatter, e.g. entity placement and migration
+LOG_DEBUG = 3 #Protocol traces, e.g. overlay views
+
+class SimianLog(object):
+    #Several logs (one per entity type, see Simian.getLog) can share one buffered file
+    def __init__(self, file, level=LOG_REPORT):
+        self.file = file
+        self.level = level
+
+    def write(self, text, level=LOG_REPORT):
+        if level <= self.level: self.file.write(text)
+
+    def flush(self): self.file.flush()
+
+    def close(self): self.file.close()
+#===========================================================================================
+
 #===========================================================================================
 # process.py
 #===========================================================================================
@@ -235,6 +258,189 @@ class Process(object):
             return "NotStarted"
 #===========================================================================================
 
+#===========================================================================================
+# eventqueue.py
+# Pending-event sets. Entries are (time, ec, event) tuples, where ec is a strictly increasing
+# counter, so that events with equal time are always served in the order they were created.
+#===========================================================================================
+_inf = float("inf")
+
+class Event(object):
+    #Compact event record: a slotted object is a fraction of the size of the 7-key dict
+    #that used to be created for every event. Item access (event["data"]) is kept for
+    #code written against the dict layout.
+    __slots__ = ("time", "name", "data", "tx", "txId", "rx", "rxId", "sid")
+
+    def __init__(self, time, name, data, tx, txId, rx, rxId, sid):
+        self.time = time #Number
+        self.name = name #String
+        self.data = data #Object
+        self.tx = tx #String
+        self.txId = txId #Number
+        self.rx = rx #String
+        self.rxId = rxId #Number
+        self.sid = sid #Number: service id of name, local to each engine (see Simian.getServiceId)
+
+    def __getitem__(self, key):
+        try: return getattr(self, key)
+        except (AttributeError, TypeError): raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if not (key in Event.__slots__): raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key): return key in Event.__slots__
+
+    def keys(self): return Event.__slots__
+
+    def get(self, key, default=None):
+        if key in Event.__slots__: return getattr(self, key)
+        return default
+
+    def __repr__(self):
+        return "Event(" + ", ".join(k + "=" + repr(getattr(self, k)) for k in Event.__slots__) + ")"
+
+class FanoutEvent(Event):
+    #One event for many entities of type rx (see Entity.reqServiceMulti), all sharing data.
+    #The engine expands it when its time is reached; rxId is None, receivers are in rxIds.
+    __slots__ = ("rxIds",)
+
+    def __init__(self, time, name, data, tx, txId, rx, rxIds, sid):
+        Event.__init__(self, time, name, data, tx, txId, rx, None, sid)
+        self.rxIds = rxIds #Tuple of Numbers
+
+    def __repr__(self):
+        return "FanoutEvent(" + ", ".join(k + "=" + repr(getattr(self, k)) for k in Event.__slots__ + FanoutEvent.__slots__) + ")"
+
+class HeapQueue(object):
+    #Binary heap: O(log n) push and pop
+    def __init__(self, width=None):
+        self.heap = []
+
+    def __len__(self): return len(self.heap)
+
+    def push(self, entry):
+        heapq.heappush(self.heap, entry)
+
+    def popBefore(self, epoch):
+        #Removes and returns the next entry if its time is < epoch, otherwise returns None
+        heap = self.heap
+        if heap and heap[0][0] < epoch: return heapq.heappop(heap)
+        return None
+
+    def popBatch(self, epoch):
+        #Removes and returns all entries sharing the next time if it is < epoch, otherwise None
+        heap = self.heap
+        if not heap or heap[0][0] >= epoch: return None
+        time = heap[0][0]
+        batch = [heapq.heappop(heap)]
+        while heap and heap[0][0] == time: batch.append(heapq.heappop(heap))
+        return batch
+
+    def minTime(self, default):
+        if self.heap: return self.heap[0][0]
+        return default
+
+    def popAll(self):
+        #Removes and returns all entries, in no particular order
+        entries = self.heap
+        self.heap = []
+        return entries
+
+class LadderQueue(object):
+    #Two-tier bucketed queue after the ladder queue of Tang, Goh and Thng (2005):
+    #future events are appended unsorted to fixed-width time buckets (O(1) push), and a
+    #bucket is sorted only once, when it becomes the bottom that events are served from.
+    #The bucket width should be close to the typical event offset (e.g. the lookahead).
+    def __init__(self, width):
+        if not width or width <= 0:
+            raise SimianError("LadderQueue(): bucket width must be positive, got: " + str(width))
+        self.invWidth = 1.0/width
+        self.rungs = {} #Bucket index -> unsorted list of entries
+        self.keys = [] #Heap of the bucket indices present in rungs
+        self.bottom = [] #Sorted entries of the bucket being served
+        self.pos = 0 #Index of next entry to serve from bottom
+        self.bottomKey = -_inf
+        self.size = 0
+
+    def __len__(self): return self.size
+
+    def push(self, entry):
+        self.size += 1
+        k = int(entry[0] * self.invWidth)
+        if k <= self.bottomKey: #Lands in the bucket being served, so keep it sorted
+            bisect.insort(self.bottom, entry, self.pos)
+            return
+        rung = self.rungs.get(k)
+        if rung is None:
+            self.rungs[k] = [entry]
+            heapq.heappush(self.keys, k)
+        else: rung.append(entry)
+
+    def _refill(self): #Hidden: make the earliest non-empty bucket the new bottom
+        k = heapq.heappop(self.keys)
+        bottom = self.rungs.pop(k)
+        bottom.sort()
+        self.bottom = bottom
+        self.pos = 0
+        self.bottomKey = k
+
+    def popBefore(self, epoch):
+        #Removes and returns the next entry if its time is < epoch, otherwise returns None
+        pos = self.pos
+        if pos == len(self.bottom):
+            if not self.keys: return None
+            self._refill()
+            pos = 0
+        bottom = self.bottom
+        entry = bottom[pos]
+        if entry[0] < epoch:
+            bottom[pos] = None #Drop reference to served event, insort never looks below pos
+            self.pos = pos + 1
+            self.size -= 1
+            return entry
+        return None
+
+    def popBatch(self, epoch):
+        #Removes and returns all entries sharing the next time if it is < epoch, otherwise None
+        pos = self.pos
+        if pos == len(self.bottom):
+            if not self.keys: return None
+            self._refill()
+            pos = 0
+        bottom = self.bottom
+        time = bottom[pos][0]
+        if time >= epoch: return None
+        end = pos + 1
+        if end < len(bottom) and bottom[end][0] == time: #Equal times always share a bucket
+            end = bisect.bisect_right(bottom, (time, _inf), end)
+        batch = bottom[pos:end]
+        bottom[pos:end] = [None] * (end - pos)
+        self.pos = end
+        self.size -= end - pos
+        return batch
+
+    def minTime(self, default):
+        if self.pos < len(self.bottom): return self.bottom[self.pos][0]
+        if self.keys:
+            self._refill()
+            return self.bottom[0][0]
+        return default
+
+    def popAll(self):
+        #Removes and returns all entries, in no particular order
+        entries = self.bottom[self.pos:]
+        for k in self.keys: entries.extend(self.rungs[k])
+        self.__init__(1.0/self.invWidth)
+        return entries
+
+#Event queue implementations selectable through Simian(..., scheduler=<name>)
+eventQueues = {
+        "heap": HeapQueue,
+        "ladder": LadderQueue,
+    }
+#===========================================================================================
+
 #===========================================================================================
 # entity.py
 #===========================================================================================
@@ -249,18 +455,35 @@ class Entity(object):
         self.num = initInfo["num"] #Serial Number
         self._procList = {} #A separate process table for each instance
         self._category = {} #A map of sets for each kind of process
+        self._dispatch = [] #Service id => bound method, filled in as services are first called
+        self._lookahead = self.engine.lookaheads.get(self.name, self.engine.minDelay) #See Simian.setLookahead
 
     def __str__(self):
         return self.name + "(" + str(self.num) + ")"
 
+    def __getstate__(self):
+        #Entities are pickled when they migrate to another rank (see Simian.migrate).
+        #The engine, log file and cached bound methods belong to the rank, not the entity.
+        if self._procList:
+            raise SimianError("entity.__getstate__(): " + self.name + "[" + str(self.num) + "] has processes and cannot migrate")
+        state = self.__dict__.copy()
+        for key in ("engine", "out", "_dispatch"): state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._dispatch = []
+
     def reqService(self, offset, eventName, data, rx=None, rxId=None):
         #Purpose: Send an event if Simian is running.
         engine = self.engine #Get the engine for this entity
 
-        if rx != None and offset < engine.minDelay:
-            if not engine.running: raise SimianError("entity.reqService(): sending event when Simian is idle!")
-            #If sending to self, then do not check against min-delay
-            raise SimianError("entity.reqService(): " + self.name + "[" + str(self.num) + "]" + " attempted to send with too little delay")
+        #If sending to self, then do not check against min-delay
+        if rx != None and offset < self._lookahead:
+            #Before the run only minDelay applies: the first window is minDelay wide
+            if not engine.running:
+                if offset < engine.minDelay: raise SimianError("entity.reqService(): sending event when Simian is idle!")
+            else: raise SimianError("entity.reqService(): " + self.name + "[" + str(self.num) + "]" + " attempted to send with too little delay")
 
         time = engine.now + offset
         if time > engine.endTime: #No need to send this event
@@ -268,29 +491,74 @@ class Entity(object):
 
         if rx == None: rx = self.name
         if rxId == None: rxId = self.num
-        e = {
-                "tx": self.name, #String
-                "txId": self.num, #Number
-                "rx": rx, #String
-                "rxId": rxId, #Number
-                "name": eventName, #String
-                "data": data, #Object
-                "time": time, #Number
-            }
+        sid = engine.serviceIds.get(eventName)
+        if sid is None: sid = engine.getServiceId(eventName)
+        e = Event(time, eventName, data, self.name, self.num, rx, rxId, sid)
 
         # this is a particular mechanism added by Jason Liu for
         # allowing different mappings from LPs to ranks
         recvRank = engine.getOffsetRank(rx, rxId)
 
         if recvRank == engine.rank: #Send to self
-            self.engine.ec += 1
-            heapq.heappush(engine.eventQueue, (time, self.engine.ec, e))
-        else:
-            MPI.COMM_WORLD.send(e, dest=recvRank)
+            engine.ec += 1
+            engine.eventQueue.push((time, engine.ec, e))
+        else: #Buffered until the end of the epoch, see Simian.exchangeEvents()
+            engine.sendBuffers[recvRank].append(e)
+            engine.remoteSent += 1
+
+    def reqServiceMulti(self, offset, eventName, data, rx, rxIds):
+        #Purpose: Send the same event to several entities of type rx, e.g. a gossip fan-out.
+        #Queues one FanoutEvent per receiving rank instead of one event per receiver. It is
+        #expanded when its time is reached, in the same order as one reqService per rxId.
+        #All receivers get the same data object, so they should not modify it.
+        engine = self.engine
+
+        if offset < self._lookahead:
+            if not engine.running:
+                if offset < engine.minDelay: raise SimianError("entity.reqServiceMulti(): sending event when Simian is idle!")
+            else: raise SimianError("entity.reqServiceMulti(): " + self.name + "[" + str(self.num) + "]" + " attempted to send with too little delay")
+
+        time = engine.now + offset
+        if time > engine.endTime or not rxIds: #No need to send this event
+            return
+
+        sid = engine.serviceIds.get(eventName)
+        if sid is None: sid = engine.getServiceId(eventName)
+
+        if engine.size == 1: #Everything is local
+            engine.ec += 1
+            engine.eventQueue.push((time, engine.ec, FanoutEvent(time, eventName, data, self.name, self.num, rx, tuple(rxIds), sid)))
+            return
+
+        rankIds = {} #Receivers split by rank, keeping their order
+        for rxId in rxIds:
+            recvRank = engine.getOffsetRank(rx, rxId)
+            if recvRank in rankIds: rankIds[recvRank].append(rxId)
+            else: rankIds[recvRank] = [rxId]
+        for recvRank in rankIds:
+            e = FanoutEvent(time, eventName, data, self.name, self.num, rx, tuple(rankIds[recvRank]), sid)
+            if recvRank == engine.rank: #Send to self
+                engine.ec += 1
+                engine.eventQueue.push((time, engine.ec, e))
+            else:
+                engine.sendBuffers[recvRank].append(e)
+                engine.remoteSent += len(e.rxIds)
 
     def attachService(self, name, fun):
         #Attaches a service at runtime to instance
         setattr(self, name, types.MethodType(fun, self))
+        self._dispatch = [] #Drop cached bound methods
+
+    def setLogLevel(self, level):
+        #Gives this entity a log of its own at level, e.g. 0 silences it (see Simian.setLogLevel)
+        self.out = SimianLog(self.engine.logFile, level)
+
+    def _bindService(self, sid): #Hidden: resolve service id to a bound method and cache it
+        dispatch = self._dispatch
+        if sid >= len(dispatch): dispatch.extend([None] * (sid + 1 - len(dispatch)))
+        service = getattr(self, self.engine.serviceNames[sid])
+        dispatch[sid] = service
+        return service
 
     #Following code is to support coroutine processes on entities:
     #Entity methods to interact with processes
@@ -404,6 +672,217 @@ class Entity(object):
         return nameSet
 #===========================================================================================
 
+#===========================================================================================
+# workers.py
+# Shared-memory parallel backend: Simian(..., workers=N) forks N-1 copies of the driver
+# process, which then carry on as ranks 1..N-1, exactly as if started by mpiexec.
+# WorkerMPI stands in for the subset of mpi4py used by Simian (COMM_WORLD, MIN, SUM and
+# Request.Waitall), so run() and exchangeEvents() are shared with the MPI backend.
+# Like MPI ranks, every worker has its own copy of the module state of the driver, e.g. the
+# random stream or lists of live nodes. Each rank draws from and updates only its copy, so a
+# model whose entities share such state runs differently than on one process. Only models
+# whose entities interact through events alone give the same results.
+#===========================================================================================
+class WorkerRequest(object):
+    @staticmethod
+    def Waitall(requests): pass #Queue.put() never blocks, its feeder thread does the writing
+
+try: from queue import Empty as QueueEmpty
+except ImportError: from Queue import Empty as QueueEmpty #Python 2
+
+class WorkerComm(object):
+    #Every rank owns one inbox queue, messages are (source, tag, obj)
+    pollInterval = 1.0 #Seconds recv() waits between checks that the other ranks are alive
+
+    def __init__(self, rank, inboxes, pids=(), parent=None):
+        self.rank = rank
+        self.size = len(inboxes)
+        self.inboxes = inboxes
+        self.inbox = inboxes[rank]
+        self.pending = {} #(source, tag) -> messages that arrived before they were asked for
+        self.pids = pids #Rank 0 only: the pids of the forked ranks 1..size-1
+        self.parent = parent #Forked ranks only: the pid of rank 0
+        self.exited = {} #rank -> exit status of the forked ranks reaped while waiting
+
+    def Get_rank(self): return self.rank
+
+    def Get_size(self): return self.size
+
+    def isend(self, obj, dest, tag=0):
+        self.inboxes[dest].put((self.rank, tag, obj))
+
+    def send(self, obj, dest, tag=0):
+        self.isend(obj, dest, tag)
+
+    def recv(self, source, tag=0):
+        key = (source, tag)
+        queued = self.pending.get(key)
+        if queued: return queued.popleft()
+        dead = None
+        while True:
+            try: message = self.inbox.get(True, self.pollInterval)
+            except QueueEmpty: message = None
+            if message is None:
+                #A rank found dead on the previous poll had a whole interval to deliver its last messages
+                if dead is not None:
+                    for inbox in self.inboxes: inbox.cancel_join_thread() #Never flush to a dead rank at exit
+                    raise SimianError("WorkerComm.recv(): rank " + str(dead) + " exited while rank " + str(self.rank) + " was waiting for a message from rank " + str(source))
+                dead = self.deadRank(source)
+                continue
+            (src, t, obj) = message
+            if src == source and t == tag: return obj
+            self.pending.setdefault((src, t), collections.deque()).append(obj)
+
+    def deadRank(self, source):
+        #A rank that has exited never sends again: returns rank 0 if it is gone, else source if
+        #it has exited or else any forked rank that has failed, else None
+        if self.parent is not None and os.getppid() != self.parent: return 0
+        for (i, pid) in enumerate(self.pids):
+            if (i + 1) in self.exited: continue
+            (reaped, status) = os.waitpid(pid, os.WNOHANG)
+            if reaped: self.exited[i + 1] = status
+        if source in self.exited: return source
+        for rank in sorted(self.exited):
+            if self.exited[rank] != 0: return rank
+        return None
+
+    def alltoall(self, objs):
+        for i in range(self.size):
+            if i != self.rank: self.isend(objs[i], i, -1)
+        return [objs[i] if i == self.rank else self.recv(i, -1) for i in range(self.size)]
+
+    def allreduce(self, value, op):
+        return op(self.alltoall([value] * self.size))
+
+    def Barrier(self):
+        self.allreduce(0, sum)
+
+class WorkerMPI(object):
+    Request = WorkerRequest
+    MIN = min
+    SUM = sum
+
+    def __init__(self, workers):
+        import multiprocessing, random
+        if not hasattr(os, "fork"):
+            raise SimianError("WorkerMPI.__init__(): the multiprocessing backend needs os.fork(), use MPI on this platform")
+        inboxes = [multiprocessing.Queue() for i in range(workers)]
+        #Every worker continues the driver with the same random state, as MPI ranks
+        #running the same seeded script would (the random module reseeds after a fork)
+        randomState = random.getstate()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        rank = 0
+        parent = None
+        self.pids = []
+        for i in range(1, workers):
+            pid = os.fork()
+            if pid == 0:
+                rank = i
+                parent = os.getppid()
+                self.pids = []
+                random.setstate(randomState)
+                break
+            self.pids.append(pid)
+        self.COMM_WORLD = WorkerComm(rank, inboxes, self.pids, parent)
+
+    def join(self):
+        #Waits for the forked workers, returns the ranks that did not exit cleanly
+        failed = []
+        exited = self.COMM_WORLD.exited
+        for (i, pid) in enumerate(self.pids):
+            if (i + 1) in exited: status = exited[i + 1]
+            else: (_, status) = os.waitpid(pid, 0)
+            if status != 0: failed.append(i + 1)
+        return failed
+#===========================================================================================
+
+#===========================================================================================
+# partition.py
+# Graph partitioning for entity placement (see Simian.setPartition and Simian.setPartitioner).
+# Every rank runs the same deterministic code on the same graph, so all of them agree on the
+# resulting placement without further communication.
+#===========================================================================================
+def partitionGraph(adjacency, parts, previous=None, passes=8, imbalance=0.03):
+    #Splits the graph {num: iterable of neighbour nums} into parts of about equal size with
+    #few edges between them: parts are grown breadth-first from the lowest unassigned num,
+    #then refined by moving boundary vertices to the part holding most of their neighbours.
+    #Edges are treated as undirected, edges to nums missing from adjacency are ignored.
+    #If previous {num: part} is given, parts are renumbered to keep most vertices in place.
+    #Returns {num: part}.
+    nodes = sorted(adjacency)
+    weights = dict((u, {}) for u in nodes)
+    for u in nodes:
+        for v in adjacency[u]:
+            if v != u and v in weights:
+                weights[u][v] = weights[u].get(v, 0) + 1
+                weights[v][u] = weights[v].get(u, 0) + 1
+
+    #Growing: part p takes (unassigned vertices)/(parts left) vertices
+    part = {}
+    sizes = [0] * parts
+    seeds = iter(nodes)
+    left = len(nodes)
+    for p in range(parts):
+        target = (left + parts - p - 1) // (parts - p)
+        frontier = collections.deque()
+        while sizes[p] < target:
+            if not frontier:
+                u = next(seeds)
+                while u in part: u = next(seeds)
+                part[u] = p
+                sizes[p] += 1
+                frontier.append(u)
+                continue
+            for v in sorted(weights[frontier.popleft()]):
+                if sizes[p] < target and not (v in part):
+                    part[v] = p
+                    sizes[p] += 1
+                    frontier.append(v)
+        left -= sizes[p]
+
+    #Refinement: greedy positive-gain moves that keep every part within the balance bounds
+    maxSize = int(math.ceil(len(nodes) * (1.0 + imbalance) / parts))
+    minSize = int(math.floor(len(nodes) * (1.0 - imbalance) / parts))
+    for _ in range(passes):
+        moved = 0
+        for u in nodes:
+            p = part[u]
+            if sizes[p] <= minSize: continue
+            links = {}
+            for v, w in weights[u].items():
+                links[part[v]] = links.get(part[v], 0) + w
+            best, gain = p, 0
+            for q in sorted(links):
+                if q != p and sizes[q] < maxSize and links[q] - links.get(p, 0) > gain:
+                    best, gain = q, links[q] - links.get(p, 0)
+            if best != p:
+                part[u] = best
+                sizes[p] -= 1
+                sizes[best] += 1
+                moved += 1
+        if moved == 0: break
+
+    if previous:
+        #Renumber parts greedily by overlap with previous, to limit the entities that move
+        overlap = {}
+        for u in nodes:
+            if u in previous:
+                key = (part[u], previous[u])
+                overlap[key] = overlap.get(key, 0) + 1
+        label = {}
+        used = set()
+        for (p, q) in sorted(overlap, key=lambda key: (-overlap[key], key)):
+            if not (p in label) and not (q in used):
+                label[p] = q
+                used.add(q)
+        free = (q for q in range(parts) if not (q in used))
+        for p in range(parts):
+            if not (p in label): label[p] = next(free)
+        part = dict((u, label[part[u]]) for u in nodes)
+    return part
+#===========================================================================================
+
 #===========================================================================================
 # umsgPack.py
 # umsgpack-python-pure can be substituted with msgpack-pure or msgpack-python
@@ -1304,7 +1783,8 @@ class umsgPack(object):
 #===========================================================================================
 class Simian(object):
     # Note: changed interface here to add silent option and default values for start and end times
-    def __init__(self, simName='simian_run', startTime=0.0, endTime=10e10, minDelay=1, useMPI=False, mpiLibName=defaultMpichLibName, silent=False):
+    def __init__(self, simName='simian_run', startTime=0.0, endTime=10e10, minDelay=1, useMPI=False, mpiLibName=defaultMpichLibName, silent=False, scheduler="heap", bucketWidth=None, batchEvents=False, workers=1, logLevel=LOG_REPORT, logBuffer=1 << 20):
+        global MPI #Module-level MPI, set by either parallel backend below
         self.Entity = Entity #Include in the top Simian namespace
 
         self.name = simName
@@ -1320,10 +1800,22 @@ class Simian(object):
         #Stores the entities available on this LP
         self.entities = {}
 
-        #Events are stored in a priority-queue or heap, in increasing
-        #order of time field. Heap top can be accessed using self.eventQueue[0]
-        #event = {time, name, data, tx, txId, rx, rxId}.
-        self.eventQueue = []
+        #Service names are interned to small integer ids when events are created, so that
+        #run() dispatches through each entity's _dispatch list instead of getattr by name
+        self.serviceIds = {}
+        self.serviceNames = []
+
+        #Events are stored in a priority-queue, in increasing order of time field.
+        #The queue implementation is chosen by name from eventQueues ("heap" or "ladder"),
+        #bucketWidth is the bucket size of the ladder queue and defaults to minDelay.
+        #entry = (time, ec, event), event = Event(time, name, data, tx, txId, rx, rxId).
+        if not (scheduler in eventQueues):
+            raise SimianError("Simian.__init__(): unknown scheduler '" + str(scheduler) + "', expected one of: " + ", ".join(sorted(eventQueues)))
+        self.scheduler = scheduler
+        self.eventQueue = eventQueues[scheduler](bucketWidth or minDelay)
+
+        #If set, run() drains all events of a timestamp from the queue in one pass
+        self.batchEvents = batchEvents
         self.ec = 0 # events created, used to work with the silly heap in Python 3 that can't compare dictionaries
 
         #Stores the minimum time of any event sent by this process,
@@ -1335,10 +1827,22 @@ class Simian(object):
         #[[Base rank is an integer hash of entity's name]]
         self.baseRanks = {}
 
+        #Explicit placement {num: rank} per entity name, overriding the round-robin of
+        #getOffsetRank (see setPartition), and periodic repartitioners per entity name
+        #as [neighbours, interval, next time] (see setPartitioner)
+        self.partitions = {}
+        self.partitioners = {}
+        self.remoteSent = 0 #Events sent to entities on other ranks
+
+        #Declared lookahead per entity name: the smallest offset with which its entities send
+        #to an explicit receiver, minDelay if not declared (see setLookahead)
+        self.lookaheads = {}
+
         #Make things work correctly with and without MPI
+        if useMPI and workers > 1:
+            raise SimianError("Simian.__init__(): useMPI and workers > 1 are mutually exclusive")
         if useMPI: #Initialize MPI
             try:
-                global MPI
                 from mpi4py import MPI
                 self.useMPI = True
                 self.MPI = MPI
@@ -1350,16 +1854,34 @@ class Simian(object):
                 self.sndCounts = [0] * self.size
                 for i in range(len(self.sndCounts)): self.sndCounts[i] = 0
                 self.rcvCounts = [0] * self.size
+                self.sendBuffers = [[] for i in range(self.size)] #Outgoing events per destination rank
+                self.eventTag = 1 #MPI tag of the per-epoch event messages
             except:
                 raise SimianError("Simian.__init__(): you have asserted useMPI - please ensure libmpich is available to ctypes before using Simian for MPI based simulations.\nTry passing absolute path to libmpich.[dylib/so/dll] to Simian.\nI tried to locate it at:\n\t" + mpiLibName + "\nand failed!")
+        elif workers > 1: #Fork shared-memory workers, which take the place of MPI ranks
+            MPI = WorkerMPI(workers)
+            self.useMPI = False
+            self.MPI = MPI
+            self.rank = MPI.COMM_WORLD.Get_rank()
+            self.size = MPI.COMM_WORLD.Get_size()
+            self.sndCounts = [0] * self.size
+            self.rcvCounts = [0] * self.size
+            self.sendBuffers = [[] for i in range(self.size)] #Outgoing events per destination rank
+            self.eventTag = 1 #Tag of the per-epoch event messages
         else:
             self.useMPI = False
             self.MPI = None
             self.rank = 0
             self.size = 1
+        self.workers = workers
 
-        #One output file per rank
-        self.out = open(self.name + "." + str(self.rank) + ".out", "w")
+        #One output file per rank, with a large write buffer, shared by the logs of the engine
+        #and of each entity type; lines above their log's level are dropped (see log.py)
+        self.logFile = open(self.name + "." + str(self.rank) + ".out", "w", logBuffer)
+        self.logLevel = logLevel
+        self.logLevels = {} #Levels set for single entity types, see setLogLevel
+        self.logs = {} #Entity name -> SimianLog
+        self.out = SimianLog(self.logFile, logLevel)
 
         # Write simulation related information in header for each output log file
         self.out.write("Simian JIT PDES Engine (" + __SimianVersion__ + ")\n")
@@ -1370,6 +1892,7 @@ class Simian(object):
         self.out.write("------------       VERSION: " + __SimianVersion__ + "      -------------\n")
         self.out.write("===================================================\n")
         if self.useMPI: self.out.write("MPI: ON\n")
+        elif self.size > 1: self.out.write("WORKERS: " + str(self.size) + "\n")
         else: self.out.write("MPI: OFF\n")
         self.out.write("===================================================\n\n")
 
@@ -1377,6 +1900,9 @@ class Simian(object):
         sys.stdout.flush()
         self.out.close()
         del self.out
+        if self.workers > 1 and not self.useMPI:
+            failed = MPI.join()
+            if failed: raise SimianError("Simian.exit(): worker rank(s) " + ", ".join(str(i) for i in failed) + " did not exit cleanly")
 
     def run(self): #Run the simulation
         startTime = perfTime()
@@ -1389,54 +1915,62 @@ class Simian(object):
             print("------------       VERSION: " + __SimianVersion__ + "      -------------")
             print("===================================================")
             if self.useMPI: print("MPI: ON")
+            elif self.size > 1: print("WORKERS: " + str(self.size))
             else: print("MPI: OFF")
             print("===================================================\n")
         numEvents = 0
 
         self.running = True
-        globalMinLeft = self.startTime
-        while globalMinLeft <= self.endTime:
-            epoch = globalMinLeft + self.minDelay
-
+        entities = self.entities
+        epoch = self.startTime + self.minDelay #No lookahead is below minDelay
+        lookahead = self.localLookahead()
+        numSyncs = 0
+        while epoch < _inf: #Events after endTime are never queued, so all queues are empty at inf
             self.minSent = self.infTime
-            while len(self.eventQueue) > 0 and self.eventQueue[0][0] < epoch:
-                (time ,_, event) = heapq.heappop(self.eventQueue) #Next event
+            if self.batchEvents:
+                numEvents = numEvents + self.runBatches(epoch)
+                entry = None
+            else:
+                popBefore = self.eventQueue.popBefore
+                entry = popBefore(epoch)
+            while entry is not None:
+                (time ,_, event) = entry #Next event
                 if self.now > time:
-                    raise SimianError("Out of order event: now=%f, evt=%f" % self.now, time)
+                    raise SimianError("Out of order event: now=%f, evt=%f" % (self.now, time))
                 self.now = time #Advance time
 
                 #Simulate event
-                entity = self.entities[event["rx"]][event["rxId"]]
-                service = getattr(entity, event["name"])
-                service(event["data"], event["tx"], event["txId"]) #Receive TO BE CGECJED
+                if event.__class__ is FanoutEvent:
+                    numEvents = numEvents + self.deliverFanout(event)
+                else:
+                    entity = entities[event.rx][event.rxId]
+                    try: service = entity._dispatch[event.sid]
+                    except IndexError: service = None
+                    if service is None: service = entity._bindService(event.sid)
+                    service(event.data, event.tx, event.txId) #Receive TO BE CGECJED
 
-                numEvents = numEvents + 1
+                    numEvents = numEvents + 1
+                entry = popBefore(epoch)
 
             if self.size > 1:
-                #toRcvCount = self.MPI.alltoallSum()
-                toRcvCount = 0
-                #ret = MPI.COMM_WORLD.alltoall([adict.get(i, None) for i in range(self.size)])
-                MPI.COMM_WORLD.alltoall(self.sndCounts)
-                for i in range(self.size):
-                    toRcvCount = toRcvCount + self.rcvCounts[i]
-                    self.sndCounts[i] = 0
-
-                while toRcvCount > 0:
-                    #self.MPI.probe()
-                    MPI.COMM_WORLD.Probe()
-                    #remoteEvent = self.MPI.recvAnySize()
-                    remoteEvent = MPI.COMM_WORLD.recv()
-                    self.ec += 1
-                    heapq.heappush(self.eventQueue, (remoteEvent["time"], self.ec, remoteEvent))
-                    toRcvCount -= 1
+                self.exchangeEvents()
 
-                minLeft = self.infTime
-                if len(self.eventQueue) > 0: minLeft = self.eventQueue[0][0]
+                #The next window ends at the earliest time at which any rank can still send an
+                #event: its earliest event plus the smallest lookahead of its entities
+                minLeft = self.eventQueue.minTime(_inf)
                 #globalMinLeft = self.MPI.allreduce(minLeft, self.MPI.MIN) #Synchronize minLeft
-                globalMinLeft = MPI.COMM_WORLD.allreduce(minLeft, MPI.MIN) #Synchronize minLeft
+                epoch = MPI.COMM_WORLD.allreduce(minLeft + lookahead, MPI.MIN) #Synchronize window
+                numSyncs += 1
+
+                for name in self.partitioners: #Same order and times on all ranks
+                    partitioner = self.partitioners[name]
+                    if partitioner[2] < epoch < _inf:
+                        self.repartition(name, partitioner[0])
+                        lookahead = self.localLookahead()
+                        while partitioner[2] < epoch: partitioner[2] += partitioner[1]
             else:
-                globalMinLeft = self.infTime
-                if len(self.eventQueue) > 0: globalMinLeft = self.eventQueue[0][0]
+                globalMinLeft = self.eventQueue.minTime(_inf)
+                epoch = globalMinLeft + self.minDelay
 
         self.running = False
 
@@ -1445,14 +1979,19 @@ class Simian(object):
             MPI.COMM_WORLD.Barrier()
             #totalEvents = self.MPI.allreduce(numEvents, self.MPI.SUM)
             totalEvents = MPI.COMM_WORLD.allreduce(numEvents, MPI.SUM)
+            remoteEvents = MPI.COMM_WORLD.allreduce(self.remoteSent, MPI.SUM)
         else:
             totalEvents = numEvents
+            remoteEvents = 0
 
         elapsedTime = perfTime() - startTime
         if self.rank == 0 and not self.silent:
             print("SIMULATION COMPLETED IN: " + str(elapsedTime) + " SECONDS")
             print("SIMULATED EVENTS: " + str(totalEvents))
             print("EVENTS PER SECOND: " + str(totalEvents/elapsedTime))
+            if self.size > 1:
+                print("CROSS-RANK EVENTS: " + str(remoteEvents) + " (" + str(float(remoteEvents)/max(totalEvents, 1)) + " of all events)")
+                print("SYNCHRONIZATIONS: " + str(numSyncs))
             print("===================================================")
         sys.stdout.flush()
 
@@ -1461,8 +2000,79 @@ class Simian(object):
         self.out.write("SIMULATION COMPLETED IN: " + str(elapsedTime) + " SECONDS\n")
         self.out.write("SIMULATED EVENTS: " + str(totalEvents) + "\n")
         self.out.write("EVENTS PER SECOND: " + str(totalEvents/elapsedTime) + "\n")
+        if self.size > 1:
+            self.out.write("CROSS-RANK EVENTS: " + str(remoteEvents) + " (" + str(float(remoteEvents)/max(totalEvents, 1)) + " of all events)\n")
+            self.out.write("SYNCHRONIZATIONS: " + str(numSyncs) + "\n")
         self.out.write("===================================================\n")
 
+    def exchangeEvents(self):
+        #Delivers the events buffered for other ranks during the epoch. Event counts are
+        #exchanged with alltoall, then every rank sends one message per destination that
+        #has events, so no rank waits on a message that will never come. All of them have
+        #time >= epoch (offset >= minDelay), so none falls inside the epoch just processed.
+        comm = MPI.COMM_WORLD
+        sendBuffers = self.sendBuffers
+        for i in range(self.size): self.sndCounts[i] = len(sendBuffers[i])
+        self.rcvCounts = comm.alltoall(self.sndCounts)
+
+        requests = [] #Non-blocking, as every rank sends before it receives
+        for i in range(self.size):
+            if self.sndCounts[i] > 0:
+                requests.append(comm.isend(sendBuffers[i], dest=i, tag=self.eventTag))
+        for i in range(self.size): #Fixed rank order keeps the queue order reproducible
+            if self.rcvCounts[i] > 0:
+                remoteEvents = comm.recv(source=i, tag=self.eventTag)
+                if len(remoteEvents) != self.rcvCounts[i]:
+                    raise SimianError("Simian.exchangeEvents(): expected " + str(self.rcvCounts[i]) + " events from rank " + str(i) + ", received " + str(len(remoteEvents)))
+                for remoteEvent in remoteEvents:
+                    remoteEvent.sid = self.getServiceId(remoteEvent.name) #Ids are local to each rank
+                    self.ec += 1
+                    self.eventQueue.push((remoteEvent.time, self.ec, remoteEvent))
+        MPI.Request.Waitall(requests)
+        self.sendBuffers = [[] for i in range(self.size)]
+
+    def deliverFanout(self, event):
+        #Calls the service of every receiver of a FanoutEvent, returns the number of events
+        rxEntities = self.entities[event.rx]
+        sid = event.sid
+        data, tx, txId = event.data, event.tx, event.txId
+        for rxId in event.rxIds:
+            entity = rxEntities[rxId]
+            try: service = entity._dispatch[sid]
+            except IndexError: service = None
+            if service is None: service = entity._bindService(sid)
+            service(data, tx, txId)
+        return len(event.rxIds)
+
+    def runBatches(self, epoch):
+        #Processes the events before epoch one timestamp at a time (batchEvents mode)
+        #Returns the number of events processed
+        entities = self.entities
+        popBatch = self.eventQueue.popBatch
+        numEvents = 0
+        batch = popBatch(epoch)
+        while batch is not None:
+            time = batch[0][0]
+            if self.now > time:
+                raise SimianError("Out of order event: now=%f, evt=%f" % (self.now, time))
+            self.now = time #Advance time
+
+            for (_, _, event) in batch:
+                if event.__class__ is FanoutEvent: rxIds = event.rxIds
+                else: rxIds = (event.rxId,)
+                rxEntities = entities[event.rx]
+                sid = event.sid
+                for rxId in rxIds:
+                    entity = rxEntities[rxId]
+                    try: service = entity._dispatch[sid]
+                    except IndexError: service = None
+                    if service is None: service = entity._bindService(sid)
+                    service(event.data, event.tx, event.txId)
+                numEvents = numEvents + len(rxIds)
+
+            batch = popBatch(epoch)
+        return numEvents
+
     def schedService(self, time, eventName, data, rx, rxId):
         #Purpose: Add an event to the event-queue.
         #For kicking off simulation and waking processes after a timeout
@@ -1472,18 +2082,20 @@ class Simian(object):
 
         #print("Simian schedService: recvRank, self.rank", recvRank, self.rank)
         if recvRank == self.rank:
-            e = {
-                    "tx": None, #String (Implictly self.name)
-                    "txId": None, #Number (Implictly self.num)
-                    "rx": rx, #String
-                    "rxId": rxId, #Number
-                    "name": eventName, #String
-                    "data": data, #Object
-                    "time": time, #Number
-                }
+            #tx and txId are None (implicitly the receiving entity itself)
+            e = Event(time, eventName, data, None, None, rx, rxId, self.getServiceId(eventName))
             #print("Simian schedService: time, e", time, e, self.ec)
             self.ec += 1
-            heapq.heappush(self.eventQueue, (time, self.ec, e))
+            self.eventQueue.push((time, self.ec, e))
+
+    def getServiceId(self, name):
+        #Interns a service name, returning its small integer id on this engine
+        sid = self.serviceIds.get(name)
+        if sid is None:
+            sid = len(self.serviceNames)
+            self.serviceIds[name] = sid
+            self.serviceNames.append(name)
+        return sid
 
     def getBaseRank(self, name):
         #Can be overridden for more complex Entity placement on ranks
@@ -1491,9 +2103,116 @@ class Simian(object):
 
     def getOffsetRank(self, name, num):
         #Can be overridden for more complex Entity placement on ranks
-        val = (self.baseRanks[name] + num) % self.size
+        partition = self.partitions.get(name)
+        if partition is not None:
+            rank = partition.get(num)
+            if rank is not None: return rank
         return (self.baseRanks[name] + num) % self.size
 
+    def getLog(self, name):
+        #Log of the entities of type name: the output file of this rank, at the level set for name
+        log = self.logs.get(name)
+        if log is None:
+            log = self.logs[name] = SimianLog(self.logFile, self.logLevels.get(name, self.logLevel))
+        return log
+
+    def setLogLevel(self, level, name=None):
+        #Sets the level of the engine's log and of entity types without a level of their own,
+        #or, if name is given, of the entities of type name only (e.g. 0 silences them)
+        if name is None:
+            self.logLevel = level
+            self.out.level = level
+            for logName in self.logs:
+                if not (logName in self.logLevels): self.logs[logName].level = level
+        else:
+            self.logLevels[name] = level
+            if name in self.logs: self.logs[name].level = level
+
+    def setLookahead(self, name, delay):
+        #Declares that entities of type name send to explicit receivers with offsets of at least
+        #delay, which reqService() enforces once the simulation runs. Parallel runs then
+        #synchronize in windows of the smallest lookahead on each rank instead of minDelay.
+        #Call before adding the entities.
+        if self.running: raise SimianError("Simian.setLookahead(): lookahead cannot change while Simian is running")
+        if not (delay >= self.minDelay):
+            raise SimianError("Simian.setLookahead(): lookahead of " + name + " must be at least minDelay (" + str(self.minDelay) + "), got: " + str(delay))
+        if name in self.entities:
+            raise SimianError("Simian.setLookahead(): entities of type " + name + " have already been added")
+        self.lookaheads[name] = delay
+
+    def localLookahead(self):
+        #Smallest declared lookahead of the entity types that have entities on this rank
+        lookaheads = [self.lookaheads.get(name, self.minDelay) for name in self.entities if self.entities[name]]
+        if lookaheads: return min(lookaheads)
+        return self.minDelay
+
+    def setPartition(self, name, ranks):
+        #Places entities of type name by ranks = {num: rank}, e.g. from partitionGraph().
+        #Call before adding the entities; nums missing from ranks are placed round-robin.
+        if self.running: raise SimianError("Simian.setPartition(): use repartition() while Simian is running")
+        self.partitions[name] = ranks
+
+    def setPartitioner(self, name, neighbours, interval):
+        #Repartitions entities of type name every interval units of simulated time, starting
+        #at the first synchronization, from the graph given by neighbours(entity) -> nums.
+        #Only has an effect when running on more than one rank.
+        if not interval or interval <= 0:
+            raise SimianError("Simian.setPartitioner(): interval must be positive, got: " + str(interval))
+        self.partitioners[name] = [neighbours, interval, self.startTime]
+
+    def repartition(self, name, neighbours):
+        #Collective: gathers the graph of entities of type name from all ranks, partitions it
+        #with partitionGraph() and migrates the entities to their new ranks
+        if self.size == 1: return
+        local = dict((num, list(neighbours(entity))) for (num, entity) in self.entities.get(name, {}).items())
+        graph = {}
+        for part in MPI.COMM_WORLD.alltoall([local] * self.size): graph.update(part)
+        previous = dict((num, self.getOffsetRank(name, num)) for num in graph)
+        self.migrate(name, partitionGraph(graph, self.size, previous))
+
+    def migrate(self, name, ranks):
+        #Collective: moves entities of type name, with their pending events, to ranks = {num: rank}.
+        #Called between epochs, when no events are in flight.
+        entities = self.entities.setdefault(name, {})
+        self.partitions[name] = ranks
+        outEntities = [[] for i in range(self.size)]
+        for num in sorted(entities):
+            rank = self.getOffsetRank(name, num)
+            if rank != self.rank: outEntities[rank].append(entities.pop(num))
+
+        outEvents = [[] for i in range(self.size)]
+        entries = self.eventQueue.popAll()
+        entries.sort() #Keep the creation order of events that move
+        for entry in entries:
+            event = entry[2]
+            if event.rx != name:
+                self.eventQueue.push(entry)
+            elif event.__class__ is FanoutEvent: #Split receivers by their new rank
+                rankIds = {}
+                for rxId in event.rxIds:
+                    rankIds.setdefault(self.getOffsetRank(name, rxId), []).append(rxId)
+                for rank in rankIds:
+                    e = FanoutEvent(event.time, event.name, event.data, event.tx, event.txId, name, tuple(rankIds[rank]), event.sid)
+                    if rank == self.rank: self.eventQueue.push((entry[0], entry[1], e))
+                    else: outEvents[rank].append(e)
+            else:
+                rank = self.getOffsetRank(name, event.rxId)
+                if rank == self.rank: self.eventQueue.push(entry)
+                else: outEvents[rank].append(event)
+
+        comm = MPI.COMM_WORLD
+        for moved in comm.alltoall(outEntities):
+            for entity in moved:
+                entity.engine = self
+                entity.out = self.getLog(name)
+                entities[entity.num] = entity
+                self.out.write(name + "[" + str(entity.num) + "]: Migrated to rank " + str(self.rank) + "\n", LOG_INFO)
+        for events in comm.alltoall(outEvents):
+            for event in events:
+                event.sid = self.getServiceId(event.name) #Ids are local to each rank
+                self.ec += 1
+                self.eventQueue.push((event.time, self.ec, event))
+
     def getEntity(self, name, num):
         #Returns a reference to a named entity of given serial number
         if name in self.entities:
@@ -1504,6 +2223,9 @@ class Simian(object):
     def attachService(self, klass, name, fun):
         #Attaches a service at runtime to an entity klass type
         setattr(klass, name, fun)
+        for entityName in self.entities: #Drop cached bound methods
+            for entity in self.entities[entityName].values():
+                entity._dispatch = []
 
     def addEntity(self, name, entityClass, num, *args, **kargs):
         #Purpose: Add an entity to the entity-list if Simian is idle
@@ -1520,11 +2242,12 @@ class Simian(object):
         computedRank = self.getOffsetRank(name, num)
         if computedRank == self.rank: #This entity resides on this engine
             #Output log file for this Entity
-            self.out.write(name + "[" + str(num) + "]: Running on rank " + str(computedRank) + "\n")
+            if self.logLevel >= LOG_INFO:
+                self.out.write(name + "[" + str(num) + "]: Running on rank " + str(computedRank) + "\n", LOG_INFO)
 
             entity[num] = entityClass({
                 "name": name,
-                "out": self.out,
+                "out": self.getLog(name),
                 "engine": self,
                 "num": num,
                 }, *args) #Entity is instantiated
@@ -0,0 +1,128 @@
+import pickle
+
+import pytest
+
+from Blockchain import Block, Blockchain, Transaction, merkle_root
+
+
+@pytest.fixture(autouse=True)
+def modelled_pow(monkeypatch):
+    monkeypatch.setattr(Blockchain, "modelled_pow", True)
+    monkeypatch.setattr(Blockchain, "max_fork_depth", 6)
+
+
+def child(parent, stamp):
+    block = Block(parent.index + 1, [], stamp, parent.hash)
+    block.hash = block.compute_hash()
+    return block
+
+
+def branch(parent, length, stamp):
+    blocks = []
+    for i in range(length):
+        parent = child(parent, stamp + i)
+        blocks.append(parent)
+    return blocks
+
+
+def new_chain():
+    chain = Blockchain()
+    chain.create_genesis_block()
+    return chain
+
+
+def hashes(blocks):
+    return [block.hash for block in blocks]
+
+
+def test_fork_of_fork_wins_once_two_blocks_ahead():
+    chain = new_chain()
+    genesis = chain.last_block
+    main = branch(genesis, 3, 1000.0)             # G a1 a2 a3
+    fork = branch(main[0], 2, 2000.0)             # a1 b2 b3
+    fork_of_fork = branch(fork[0], 3, 3000.0)     # b2 c3 c4 c5
+    for block in main + fork:
+        assert chain.consensus(block)
+    assert chain.last_block is main[-1]
+
+    # c3 builds on b2, which is neither on the main chain nor a fork tip
+    assert chain.consensus(fork_of_fork[0])
+    # c4 is one block ahead of a3: not enough to switch
+    assert chain.consensus(fork_of_fork[1])
+    assert chain.last_block is main[-1]
+    # c5 is two blocks ahead: the fork of the fork becomes the main chain
+    assert chain.consensus(fork_of_fork[2])
+    assert hashes(chain.chain) == hashes([genesis, main[0], fork[0]] + fork_of_fork)
+
+
+def test_fork_of_fork_out_of_order():
+    chain = new_chain()
+    genesis = chain.last_block
+    main = branch(genesis, 3, 1100.0)
+    fork = branch(main[0], 2, 2100.0)
+    fork_of_fork = branch(fork[0], 3, 3100.0)
+    for block in main + fork_of_fork[::-1]:
+        chain.consensus(block)
+    assert chain.last_block is main[-1]
+    # b2 arrives last and brings its fork and the orphans waiting on it
+    for block in fork[::-1]:
+        chain.consensus(block)
+    assert hashes(chain.chain) == hashes([genesis, main[0], fork[0]] + fork_of_fork)
+    assert len(chain.orphans) == 0
+
+
+def test_stale_fork_tips_are_pruned():
+    chain = new_chain()
+    genesis = chain.last_block
+    fork = branch(genesis, 1, 4000.0)
+    main = branch(genesis, 9, 5000.0)
+    assert chain.consensus(main[0])
+    assert chain.consensus(fork[0])
+    assert fork[0].hash in chain.tips
+    for block in main[1:7]:
+        chain.consensus(block)
+    # best at height 7: the fork tip at height 1 is exactly max_fork_depth below
+    assert fork[0].hash in chain.tips
+    chain.consensus(main[7])
+    assert set(chain.tips) == {main[7].hash}
+    chain.consensus(main[8])
+    # a block on the pruned fork, below the fork depth, is dropped rather
+    # than kept as an orphan
+    assert not chain.consensus(child(fork[0], 4001.0))
+    assert len(chain.orphans) == 0
+
+
+def test_pending_tree_follows_the_mempool(monkeypatch):
+    monkeypatch.setattr(Blockchain, "block_size", 4)
+    hashed = []
+    hash_bytes = Transaction.hash_bytes
+    monkeypatch.setattr(Transaction, "hash_bytes", lambda tx: hashed.append(tx) or hash_bytes(tx))
+    chain = new_chain()
+    txs = [Transaction(i % 3) for i in range(7)]
+    for tx in txs:
+        chain.add_new_transaction(tx)
+    chain.add_new_transaction(txs[0])
+
+    def expected_root():
+        return merkle_root([tx.hash_bytes() for tx in chain.mempool.head(Blockchain.block_size)])
+
+    assert chain.pending_tree().root() == expected_root()
+    assert hashed[:4] == txs[:4]
+    # Another miner's block confirms txs[2] and a transaction beyond the pending block
+    del hashed[:]
+    chain.remove_confirmed_transactions(Block(1, [txs[2], txs[5]], 1000.0, "0"))
+    assert chain._pending_txs == [txs[0], txs[1], txs[3], txs[4]]
+    chain.pending_tree()
+    # Only the leaves after the first confirmed transaction are hashed again
+    assert hashed == [txs[3], txs[4]]
+    assert chain.pending_tree().root() == expected_root()
+
+
+@pytest.mark.parametrize("author", [7, "node-7", 2 ** 70, None])
+def test_pickled_block_keeps_any_author(author):
+    txs = [Transaction(author), Transaction(3)]
+    block = Block(1, txs, 1000.0, "0")
+    copy = pickle.loads(pickle.dumps(block))
+    assert [(tx.number, tx.author, tx.timestamp) for tx in copy.transactions] == \
+        [(tx.number, tx.author, tx.timestamp) for tx in txs]
+    assert copy.compute_hash() == block.compute_hash()
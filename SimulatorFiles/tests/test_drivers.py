@@ -0,0 +1,27 @@
+import os
+import re
+import subprocess
+import sys
+
+SIMULATOR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_report(tmp_path, name, *args):
+    """Run a driver in its own directory and return its report without the timing lines."""
+    workdir = tmp_path / name
+    (workdir / "LazyPushSimulation").mkdir(parents=True)
+    subprocess.run([sys.executable, os.path.join(SIMULATOR_DIR, "BlockLazyPush.py")] + list(args),
+                   cwd=str(workdir), check=True, stdout=subprocess.DEVNULL)
+    [out] = (workdir / "LazyPushSimulation").iterdir()
+    return [line for line in out.read_text().splitlines()
+            if "SECOND" not in line and "SIMULATION COMPLETED" not in line]
+
+
+def test_retention_under_churn_matches_full_history(tmp_path):
+    churn = ["150", "300", "-l", "0.01", "--seedR", "5", "--activeChurn", "1", "--failRate", "0.2"]
+    full = run_report(tmp_path, "full", *churn)
+    assert any("Reliability" in line for line in full)
+    # Expired entries belong to the node that saw them, so a churned node forgets them too
+    assert run_report(tmp_path, "retained", *churn + ["--retention", "20"]) == full
+    reliabilities = [float(value) for value in re.findall(r"Reliability:([0-9.]+)%", "\n".join(full))]
+    assert max(reliabilities) <= 100.0
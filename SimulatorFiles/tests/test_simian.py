@@ -0,0 +1,207 @@
+import os
+import queue
+import random
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import simian
+from simian import Event, Simian, WorkerComm, WorkerRequest
+
+
+class ThreadMPI:
+    """
+    The subset of mpi4py used by Simian for ranks running as threads of one
+    process: COMM_WORLD is the WorkerComm of the calling thread's rank.
+    """
+    Request = WorkerRequest
+    MIN = min
+    SUM = sum
+
+    def __init__(self, size):
+        self.inboxes = [queue.Queue() for i in range(size)]
+        self.local = threading.local()
+
+    @property
+    def COMM_WORLD(self):
+        return self.local.comm
+
+    def run_ranks(self, target):
+        """Call target(rank) on one thread per rank, re-raising the first error."""
+        errors = []
+
+        def start(rank):
+            self.local.comm = WorkerComm(rank, self.inboxes)
+            try:
+                target(rank)
+            except BaseException as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=start, args=(rank,)) for rank in range(len(self.inboxes))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+        if errors:
+            raise errors[0]
+
+
+def make_engine(name, rank, size, endTime=50.0, minDelay=0.5):
+    engine = Simian(name + "-" + str(rank), 0, endTime, minDelay, silent=True)
+    engine.rank = rank
+    engine.size = size
+    engine.sndCounts = [0] * size
+    engine.rcvCounts = [0] * size
+    engine.sendBuffers = [[] for i in range(size)]
+    engine.eventTag = 1
+    return engine
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Every engine writes its .out file to the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+def test_exchange_events_with_uneven_counts(workdir, monkeypatch):
+    size = 3
+    mpi = ThreadMPI(size)
+    monkeypatch.setattr(simian, "MPI", mpi, raising=False)
+    engines = [make_engine("exchange", rank, size) for rank in range(size)]
+    # Rank src sends src * 3 + dst events to every other rank, none to rank 0 from rank 0
+    counts = {(src, dst): src * 3 + dst for src in range(size) for dst in range(size) if src != dst}
+    for (src, dst), count in counts.items():
+        for i in range(count):
+            engines[src].sendBuffers[dst].append(
+                Event(1.0 + i, "Hop", (src, i), "Cell", src, "Cell", dst, -1))
+
+    mpi.run_ranks(lambda rank: engines[rank].exchangeEvents())
+
+    for dst, engine in enumerate(engines):
+        assert engine.rcvCounts == [counts.get((src, dst), 0) for src in range(size)]
+        assert engine.sendBuffers == [[] for i in range(size)]
+        received = []
+        while engine.eventQueue.minTime(float("inf")) != float("inf"):
+            received.append(engine.eventQueue.popBefore(float("inf")))
+        # Queued in source rank order, each source in the order it buffered them
+        ordered = sorted(received, key=lambda entry: entry[1])
+        assert [entry[2].data for entry in ordered] == [
+            (src, i) for src in range(size) for i in range(counts.get((src, dst), 0))]
+        assert all(entry[2].sid == engine.serviceIds["Hop"] for entry in received)
+
+
+def phold(engine, cells, lookahead, seed):
+    """A PHOLD model: every cell forwards each event to a random cell."""
+
+    class Cell(engine.Entity):
+        def __init__(self, baseInfo, *args):
+            super(Cell, self).__init__(baseInfo)
+            self.rng = random.Random(seed * 1000 + self.num)
+            self.received = []
+            for i in range(2):
+                self.reqService(lookahead + self.rng.random(), "Hop", i, "Cell", self.rng.randrange(cells))
+
+        def Hop(self, data, tx, txId):
+            self.received.append((self.engine.now, txId, data))
+            self.reqService(lookahead + self.rng.expovariate(1.0), "Hop", data, "Cell", self.rng.randrange(cells))
+
+    engine.setLookahead("Cell", lookahead)
+    for num in range(cells):
+        engine.addEntity("Cell", Cell, num)
+
+
+def run_phold(size, monkeypatch, cells=12, lookahead=0.5, seed=7):
+    engines = [make_engine("phold", rank, size, minDelay=lookahead / 5) for rank in range(size)]
+    for engine in engines:
+        phold(engine, cells, lookahead, seed)
+    if size == 1:
+        engines[0].run()
+    else:
+        mpi = ThreadMPI(size)
+        monkeypatch.setattr(simian, "MPI", mpi, raising=False)
+        mpi.run_ranks(lambda rank: engines[rank].run())
+    received = {}
+    for engine in engines:
+        engine.exit()
+        for num, cell in engine.entities["Cell"].items():
+            received[num] = cell.received
+    return received
+
+
+def test_parallel_run_matches_sequential(workdir, monkeypatch):
+    sequential = run_phold(1, monkeypatch)
+    assert sum(len(events) for events in sequential.values()) > 500
+    assert run_phold(3, monkeypatch) == sequential
+    assert run_phold(4, monkeypatch) == sequential
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_ladder_queue_matches_heap_queue(seed):
+    rng = random.Random(seed)
+    width = rng.choice([0.25, 0.5, 1.0, 3.0])
+    heap, ladder = simian.HeapQueue(), simian.LadderQueue(width)
+    now = 0.0
+    ec = 0
+    for step in range(3000):
+        op = rng.random()
+        if op < 0.55:
+            # Offsets on a coarse grid give equal times and inserts into the bucket being served
+            ec += 1
+            entry = (now + rng.choice([0.0, 0.0, 0.125, 0.25, width, rng.randrange(40) * 0.125]), ec, "e" + str(ec))
+            heap.push(entry)
+            ladder.push(entry)
+        elif op < 0.75:
+            epoch = now + rng.choice([0.0, 0.125, width, float("inf")])
+            entry = heap.popBefore(epoch)
+            assert ladder.popBefore(epoch) == entry
+            if entry is not None: now = entry[0]
+        elif op < 0.9:
+            epoch = now + rng.choice([0.0, 0.125, width, float("inf")])
+            batch = heap.popBatch(epoch)
+            assert ladder.popBatch(epoch) == batch
+            if batch is not None: now = batch[0][0]
+        elif op < 0.998:
+            assert ladder.minTime(-1.0) == heap.minTime(-1.0)
+        else:
+            assert sorted(ladder.popAll()) == sorted(heap.popAll())
+        assert len(ladder) == len(heap)
+    assert sorted(ladder.popAll()) == sorted(heap.popAll())
+    assert ladder.minTime(None) is None and ladder.popBefore(float("inf")) is None
+
+
+FAILING_MODEL = """
+import sys
+sys.path.insert(0, {path!r})
+import simian
+simian.WorkerComm.pollInterval = 0.2
+engine = simian.Simian("failing", 0, 100, 0.5, False, workers=3, silent=True)
+
+class Cell(engine.Entity):
+    def __init__(self, baseInfo, *args):
+        super(Cell, self).__init__(baseInfo)
+        self.reqService(1, "Hop", None)
+
+    def Hop(self, data, tx, txId):
+        if self.engine.now > 10 and self.engine.rank == {failing}: raise RuntimeError("Hop failed")
+        self.reqService(1, "Hop", None, "Cell", (self.num + 1) % 6)
+
+engine.setLookahead("Cell", 1)
+for num in range(6):
+    engine.addEntity("Cell", Cell, num)
+engine.run()
+engine.exit()
+"""
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="the workers backend forks")
+@pytest.mark.parametrize("failing", [0, 1])
+def test_workers_raise_when_a_rank_dies(tmp_path, failing):
+    script = tmp_path / "failing.py"
+    script.write_text(FAILING_MODEL.format(path=os.path.dirname(simian.__file__), failing=failing))
+    result = subprocess.run([sys.executable, str(script)], cwd=str(tmp_path), timeout=30,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode != 0
+    assert "RuntimeError: Hop failed" in result.stderr
+    assert "SimianError: WorkerComm.recv(): rank " + str(failing) + " exited" in result.stderr